@@ -12,19 +12,33 @@
 #|          |Moran's I, depending on various ways of calculating spatial lags.|
 #+----------+-----------------------------------------------------------------+
 
-import geopandas as gpd
-import matplotlib, tooltip
-import matplotlib.pyplot as plt
+import tooltip, matrixview, worker, weights, moran, core, cache, instrument
 import numpy as np
+import os
 import pandas as pd
-from scipy import stats 
 import tkinter as tk
-from pandastable import Table
-from tkinter import ttk
-from PIL import Image, ImageTk
-from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
-from matplotlib.backends.backend_tkagg import (NavigationToolbar2Tk)
-matplotlib.use('TkAgg')
+from tkinter import filedialog, messagebox, ttk
+
+#Plotting, the map canvas and the table widget are imported the first time
+#they are shown, the icons are decoded by Tk itself
+ICONS = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'imgs')
+
+
+
+def pyplot():
+    "matplotlib.pyplot on the Tk backend"
+    import matplotlib
+    matplotlib.use('TkAgg')
+    import matplotlib.pyplot as plt
+    return plt
+
+def resolution(low, high, steps=500):
+    "Power of ten slider step giving about steps positions from low to high"
+    return 10.0 ** np.floor(np.log10((high - low) / steps)) if high > low else 1.0
+
+def icon(name):
+    "Button icon from the imgs folder"
+    return tk.PhotoImage(file= os.path.join(ICONS, f'{name}.png'))
 
 
 
@@ -42,26 +56,32 @@ class MainWindow:
         self.feat = ''
         self.method = ''
         self.neighbormethod = ''
+        self.engine = core.ENGINES[0]
         self.neighN = 0
         self.buffer = tk.DoubleVar(value= 0)
+        self.snap = tk.DoubleVar(value= 0)
         self.Dist = 0
         self.power = 0
         self.MoransI = 0
-        self.perm = 0
+        self.perm = 999
+        self.inference = moran.INFERENCE[0]
+        self.seed = tk.StringVar(value='')
+        self.workers = os.cpu_count() or 1
+        self.store = cache.WeightsCache()
                
-        self.imageFolder = ImageTk.PhotoImage(Image.open('./imgs/folder.png'))
-        self.imageAttrTable = ImageTk.PhotoImage(Image.open('./imgs/table.png'))
-        self.imageOutliers = ImageTk.PhotoImage(Image.open('./imgs/outliers.png'))
-        self.imageMethod = ImageTk.PhotoImage(Image.open('./imgs/method.png'))
-        self.imageDistance = ImageTk.PhotoImage(Image.open('./imgs/distance.png'))
-        self.imageCalc = ImageTk.PhotoImage(Image.open('./imgs/calc.png'))
-        self.imageResults = ImageTk.PhotoImage(Image.open('./imgs/atr.png'))
-        self.imageSave = ImageTk.PhotoImage(Image.open('./imgs/save.png'))
-        self.imageRefresh = ImageTk.PhotoImage(Image.open('./imgs/refresh.png'))
-        self.imageHelp = ImageTk.PhotoImage(Image.open('./imgs/help.png'))    
-        self.imageOk = ImageTk.PhotoImage(Image.open('./imgs/ok.png'))
-        self.imageBack = ImageTk.PhotoImage(Image.open('./imgs/back.png'))
-        self.imageOutliers2 = ImageTk.PhotoImage(Image.open('./imgs/outliers2.png'))
+        self.imageFolder = icon('folder')
+        self.imageAttrTable = icon('table')
+        self.imageOutliers = icon('outliers')
+        self.imageMethod = icon('method')
+        self.imageDistance = icon('distance')
+        self.imageCalc = icon('calc')
+        self.imageResults = icon('atr')
+        self.imageSave = icon('save')
+        self.imageRefresh = icon('refresh')
+        self.imageHelp = icon('help')    
+        self.imageOk = icon('ok')
+        self.imageBack = icon('back')
+        self.imageOutliers2 = icon('outliers2')
       
         self.button = tk.Button(self.frame, image= self.imageFolder, command=lambda: self.readshp(), bg= '#565051', activebackground= '#565051', relief='flat', highlightthickness=0, bd=0)
         self.button.place(relx=0.015, rely=0, relwidth= 0.12, relheight= 0.1)
@@ -94,96 +114,66 @@ class MainWindow:
         self.button8 = tk.Button(self.frame, image= self.imageRefresh, bg= '#565051', state= 'disabled', command=lambda: self.ResetApp(), activebackground= '#565051', relief='flat', highlightthickness=0, bd=0)
         self.button8.place(relx=0.855, rely=0, relwidth= 0.12, relheight= 0.1)
         tooltip.CreateToolTip(self.button8, "Reset application", 40, 45)   
+        self.progressWidgets()
 
 #-----------------------------------------------------------------------------#
 #------------------------- R E A D   S H A P E F I L E -----------------------#
 #-----------------------------------------------------------------------------#
     def readshp(self):
-        self.filename = tk.filedialog.askopenfilename(initialdir= ".", filetypes=[("ESRI shape files", "*.shp")])
+        self.filename = filedialog.askopenfilename(initialdir= ".", filetypes= core.LAYER_TYPES)
         
         if self.filename:
-            try:
-                del self.canvas  
-            except:
-                pass
-            self.polygons = gpd.GeoDataFrame.from_file(self.filename)
+            #Only the geometry is read here, attributes are read when selected
+            filename = self.filename
+            stages = self.stages = instrument.Stages()
             
-            self.names = self.polygons.columns
-            self.atr = list(self.names[1:-1])
+            def job(progress):
+                with stages.stage('load') as record:
+                    layer = core.loadLayer(filename, columns= [])
+                    record['n'] = len(layer)
+                return layer, core.layerFields(filename), core.layerAttributes(filename)
+            self.startJob('Loading layer', job, self.showLayer)
             
 #-------------------------- P L O T   S H A P E F I L E ----------------------#     
-            self.f, self.ax = plt.subplots(figsize=(5,4), dpi=100)
-            self.f.tight_layout(pad=0)
-            self.ax.set_aspect('equal')
-            
-            self.ax = self.polygons.plot(ax= self.ax, color= '#FFE4B5', edgecolor= 'k', clip_on=False)
-            self.f.set_facecolor("#98AFC7")
-            self.ax.axis('off')
-            plt.close()
-            
-            self.ax.fmt_xdata = lambda x: "{:.3f}".format(x)  
-            self.ax.fmt_ydata = lambda x: "{:.3f}".format(x)
-    
-            self.canvas = FigureCanvasTkAgg(self.f, master=self.frame)
-            self.canvas.get_tk_widget().place(relx= 0.15, rely= 0.19, relheight= 0.65, relwidth= 0.7)
-            self.canvas.draw()
-            
-            self.toolbar = NavigationToolbar2Tk(self.canvas, self.frame)
-            for button in self.toolbar.winfo_children():
-                button.config(background='#565051')
-            self.toolbar.config(background='#565051')
-            self.toolbar._message_label.place(relx=0.04, rely=0.02)
-            self.toolbar.place(relx= 0.26, rely= 0.85, relheight=0.19)
-            self.toolbar.update()
-
-            self.button2.config(state= 'normal')
-            self.button8.config(state= 'normal')
-            return(self.atr)
+    def showLayer(self, layer):
+        self.polygons, self.names, self.atr = layer
+        self.clearRun()
+        self.showMap().setLayer(self.polygons.geometry.values)
+        
+        self.button2.config(state= 'normal')
+        self.button8.config(state= 'normal')
         
 #-----------------------------------------------------------------------------#        
 #--- P L O T   C E N T R O I D S  &  C A L C U L A T E   D I S T A N C E S ---#
 #-----------------------------------------------------------------------------# 
     def calcDistances(self):
-        self.centroids = self.polygons.centroid
+        polygons, stages = self.polygons, self.stages
+        
+        def job(progress):
+            with stages.stage('centroids'):
+                centroids = polygons.centroid
+                coords = np.column_stack([centroids.x, centroids.y])
+                #Radius slider bounds from a nearest neighbor pass on the centroids
+                tree = weights.pointTree(coords)
+                return (centroids, coords, tree) + weights.distanceBounds(coords, tree)
+        self.startJob('Centroids', job, self.showCentroids)
+        
+    def showCentroids(self, result):
+        self.centroids, self.coords, self.tree, self.minDist, self.maxDist = result
         #self.centroids.to_file("hdMoransIcentroids.shp")
+        self.candidates = weights.Candidates(self.coords, self.tree)
+        self.showMap().setCentroids(self.coords)
+        self.button5.config(state='normal')
+    def showMap(self):
+        #One map canvas and toolbar per main frame, layers are swapped in place
+        if self.mapView is None:
+            import mapview
+            self.mapView = mapview.MapView(self.frame)
+            self.mapView.canvas.get_tk_widget().place(relx= 0.15, rely= 0.19, relheight= 0.65, relwidth= 0.7)
+            self.mapView.toolbar.place(relx= 0.26, rely= 0.85, relheight=0.19)
+            self.mapView.toolbar.update()
+        return self.mapView
         
-        try:
-            del self.canvas  
-        except:
-            pass
- 
-        self.f, self.ax = plt.subplots(figsize=(5,4), dpi=100)
-        self.ax.set_aspect('equal')
-        self.f.tight_layout(pad=0)
-            
-        self.ax = self.polygons.plot(ax= self.ax, color= '#FFE4B5', edgecolor= 'k', clip_on=False)
-        self.centroids.plot(ax= self.ax, color= 'green', markersize=10)
-        self.f.set_facecolor("#98AFC7")
-        self.ax.axis('off')
-        plt.close()
-        
-        self.ax.fmt_xdata = lambda x: "{:.3f}".format(x)  
-        self.ax.fmt_ydata = lambda x: "{:.3f}".format(x)
-
-        self.canvas = FigureCanvasTkAgg(self.f, master=self.frame)
-        self.canvas.get_tk_widget().place(relx= 0.15, rely= 0.19, relheight= 0.65, relwidth= 0.7)
-        self.canvas.draw()
-        
-        self.toolbar = NavigationToolbar2Tk(self.canvas, self.frame)
-        for button in self.toolbar.winfo_children():
-            button.config(background='#565051')
-        self.toolbar.config(background='#565051')
-        self.toolbar._message_label.place(relx=0.04, rely=0.02)
-        self.toolbar.place(relx= 0.26, rely= 0.85, relheight=0.19)
-        self.toolbar.update()
-       
-        self.dists = np.array(self.centroids.geometry.apply(lambda g: self.centroids.geometry.distance(g)))
-        
-        #self.minDist = self.dists.mask(self.dists == 0).min().min()
-        #self.maxDist = self.dists.mask(self.dists == 0).max().max() 
-        
-        self.minDist = np.min(self.dists[np.nonzero(self.dists)])
-        self.maxDist = np.max(self.dists[np.nonzero(self.dists)])
 #-----------------------------------------------------------------------------#
 #--------------------------- F E A T U R E   M E N U -------------------------#
 #-----------------------------------------------------------------------------#  
@@ -205,8 +195,11 @@ class MainWindow:
                     
     def Featclick(self):
         self.feat = self.currentFeat.get()
+        if self.feat not in self.polygons.columns:
+            self.polygons[self.feat] = core.loadColumns(self.filename, [self.feat])[self.feat]
         self.ft = self.polygons[self.feat]
         self.n = len(self.ft)
+        self.dev = None
         self.lfeat.set(f'{self.feat}')
         self.button3.config(state='normal')
         self.button4.config(state='normal')
@@ -222,7 +215,7 @@ class MainWindow:
         display.max_rows = 100
         display.max_colwidth = 199
         display.width = None
-        self.dataTable = self.polygons.loc[:, self.polygons.columns != 'geometry']
+        self.dataTable = core.loadColumns(self.filename).loc[self.polygons.index]
              
     def showTable(self):
         self.attrTable()
@@ -234,6 +227,7 @@ class MainWindow:
         self.winFrame = tk.Frame(self.winTable, bg= '#565051')
         self.winFrame.place(relx= 0, rely=0, relheight= 1, relwidth= 1)
         
+        from pandastable import Table
         self.pt = Table(self.winFrame, dataframe= self.dataTable, showtoolbar=True, showstatusbar=True)
         self.pt.show()  
     
@@ -256,7 +250,7 @@ class MainWindow:
         self.ft = pd.DataFrame(self.ft)        
         Q1 = self.ft.quantile(q=.25)
         Q3 = self.ft.quantile(q=.75)
-        IQR = self.ft.apply(stats.iqr)
+        IQR = Q3 - Q1
 
         self.data_clean = self.ft[~((self.ft < (Q1-1.5*IQR)) | (self.ft > (Q3+1.5*IQR))).any(axis=1)]
         self.ft = np.array(self.ft)
@@ -265,23 +259,26 @@ class MainWindow:
         
         if np.size(self.outlist) > 0:   
             self.plotData()         
-            self.responseOut = tk.messagebox.askyesno('Outliers:', f'{np.size(self.outlist)} outliers detected. Do you want to remove them?')
+            self.responseOut = messagebox.askyesno('Outliers:', f'{np.size(self.outlist)} outliers detected. Do you want to remove them?')
             
             if self.responseOut == 1:
                 self.polygons = self.polygons[~self.polygons[self.feat].isin(self.outlist)]
                 self.ft = self.polygons[self.feat]
                 self.n = len(self.ft)
+                self.clearRun()
+                self.showMap().setLayer(self.polygons.geometry.values)
                 self.plotData2()
             else:
                 pass      
         else:
             self.plotData()
-            tk.messagebox.showinfo('Outliers:', 'No outliers detected.')
+            messagebox.showinfo('Outliers:', 'No outliers detected.')
  
 #-----------------------------------------------------------------------------#
 #-------------------- P L O T   W I T H   O U T L I E R S --------------------#
 #-----------------------------------------------------------------------------#      
     def plotData(self): 
+        plt = pyplot()
         self.indexes = np.arange(1,self.n+1)
         self.col = np.where(np.in1d(self.ft, self.data_clean), 'g', 'r')
                 
@@ -301,6 +298,7 @@ class MainWindow:
 #------------- P L O T   A F T E R   R E M O V I N G   O U T L I E R S -------#  
 #-----------------------------------------------------------------------------# 
     def plotData2(self): 
+        plt = pyplot()
         self.indexes = np.arange(1,self.n+1)
                 
         fig = plt.figure(figsize= (7,4), dpi=100)
@@ -320,25 +318,39 @@ class MainWindow:
 #-----------------------------------------------------------------------------#  
     def callwinMethod(self):
         self.winMethod = tk.Toplevel(self.master, bg= '#565051')
-        self.winMethod.geometry("300x150+500+50")
+        self.winMethod.geometry("300x320+500+50")
         self.currentMethod = tk.StringVar()
         self.labelMethod = tk.Label(self.winMethod, text= "Select Method:", bg= '#565051').pack(pady=10)
-        self.methods = ['Neighbors', 'Distance', 'Inverse Distance']
+        self.methods = core.METHODS
         self.comboMethod = ttk.Combobox(self.winMethod, value= self.methods, textvariable= self.currentMethod, state="readonly")
         self.comboMethod.current(0)
         self.comboMethod.pack(pady=10)
+        self.currentInference = tk.StringVar(value= self.inference)
+        self.labelInference = tk.Label(self.winMethod, text= "Inference:", bg= '#565051').pack(pady=2)
+        self.comboInference = ttk.Combobox(self.winMethod, value= moran.INFERENCE, textvariable= self.currentInference, state="readonly", width= 15)
+        self.comboInference.pack(pady=2)
+        self.currentPerm = tk.StringVar(value= self.perm)
+        self.labelPerm = tk.Label(self.winMethod, text= "Permutations:", bg= '#565051').pack(pady=2)
+        self.comboPerm = ttk.Combobox(self.winMethod, value= [99, 999, 9999], textvariable= self.currentPerm, width= 10)
+        self.comboPerm.pack(pady=2)
+        self.labelSeed = tk.Label(self.winMethod, text= "Random seed:", bg= '#565051').pack(pady=2)
+        self.entrySeed = tk.Entry(self.winMethod, textvariable= self.seed, bd=2, justify= 'c', width= 10)
+        self.entrySeed.pack(pady=2)
         
         self.buttonOkMethod = tk.Button(self.winMethod, image=  self.imageOk,activebackground= '#565051', command= lambda: self.Methodclick(), bg= '#565051', relief='flat', highlightthickness=0, bd=0, width= 50)
         self.buttonOkMethod.pack(pady=10)
             
     def Methodclick(self):
         self.method = self.currentMethod.get()
+        self.inference = self.currentInference.get()
+        self.perm = max(1, int(self.currentPerm.get()))
         self.lfeat.set(f'{self.feat} / {self.method}')
-        self.button5.config(state='normal')
         self.winMethod.destroy()
         
         if self.method == self.methods[1] or self.method == self.methods[2]:
             self.calcDistances()
+        else:
+            self.button5.config(state='normal')
         return(self.method)
     
 #-----------------------------------------------------------------------------#   
@@ -347,19 +359,27 @@ class MainWindow:
     def callwinNeighbor(self):
         if self.method == self.methods[0]:
             self.winNeighbor = tk.Toplevel(self.master, bg= '#565051')
-            self.winNeighbor.geometry("300x250+500+50")
+            self.winNeighbor.geometry("300x350+500+50")
             self.currentNeighbor = tk.StringVar()
             self.labelNeighMethod = tk.Label(self.winNeighbor, text= "Select Method:", bg= '#565051').pack(pady=5)
-            self.neighbormethods = ['Rook', 'Queen']
+            self.neighbormethods = core.NEIGHBOR_METHODS
             self.comboNeighbor= ttk.Combobox(self.winNeighbor, value= self.neighbormethods, textvariable= self.currentNeighbor, state="readonly")
             self.comboNeighbor.current(0)
             self.comboNeighbor.pack(pady=5)
+            self.currentEngine = tk.StringVar(value= core.ENGINE_LABELS[core.ENGINES.index(self.engine)])
+            self.comboEngine = ttk.Combobox(self.winNeighbor, value= core.ENGINE_LABELS, textvariable= self.currentEngine, state="readonly", width= 34)
+            self.comboEngine.pack(pady=2)
+            tooltip.CreateToolTip(self.comboEngine, "Contiguity definition, it changes the neighbors:\nPredicates: Rook intersects, Queen touches\nShared vertices: Rook shares an edge, Queen a vertex\n(faster on clean layers such as census tracts)", 40, 45)
             self.labelNeighNumber = tk.Label(self.winNeighbor, text= "Select Number of Neighbors:", bg= '#565051').pack(pady=5)
             self.neighSlider = tk.Scale(self.winNeighbor, from_= 1, to= self.n-1, orient= 'horizontal', bg= '#565051', relief='flat', bd=0)
             self.neighSlider.pack(pady=5)
             self.labelbuffer = tk.Label(self.winNeighbor, text= "Add buffer size:", bg= '#565051').pack(pady=2)
             self.entrybuffer = tk.Entry(self.winNeighbor, textvariable= self.buffer, bd=2, justify= 'c', width= 10)
             self.entrybuffer.pack(pady=2)
+            self.labelsnap = tk.Label(self.winNeighbor, text= "Snap tolerance (shared vertices):", bg= '#565051').pack(pady=2)
+            self.entrysnap = tk.Entry(self.winNeighbor, textvariable= self.snap, bd=2, justify= 'c', width= 10)
+            self.entrysnap.pack(pady=2)
+            tooltip.CreateToolTip(self.entrysnap, "Grid the shared vertices are snapped to, polygons it collapses are linked with predicates.\nA buffer always uses the predicates", 40, 45)
             
             self.buttonOkNeighbor = tk.Button(self.winNeighbor, image=  self.imageOk, activebackground= '#565051',command= lambda: self.Neighborclick(),bg= '#565051',  relief='flat', highlightthickness=0, bd=0, width= 50)
             self.buttonOkNeighbor.pack(pady=6)
@@ -369,10 +389,11 @@ class MainWindow:
             self.winDistance.geometry("300x200+500+50")
             self.currentDistance = tk.StringVar()
             self.labelDist = tk.Label(self.winDistance, text= "Select Radius Distance:", bg= '#565051').pack(pady=4)
-            self.distanceSlider = tk.Scale(self.winDistance, from_= self.minDist, to= self.maxDist, orient= 'horizontal', bg= '#565051', relief='flat', bd=0)
+            self.distanceSlider = self.radiusSlider(self.winDistance)
             self.distanceSlider.pack(pady=4)
-            self.labelNeighNumber = tk.Label(self.winDistance, text= "Select Number of Neighbors:", bg= '#565051').pack(pady=4)
-            self.neighSlider = tk.Scale(self.winDistance, from_= 1, to= self.n-1, orient= 'horizontal', bg= '#565051', relief='flat', bd=0)
+            self.labelNeighNumber = tk.Label(self.winDistance, text= "Select Number of Neighbors (0: all in radius):", bg= '#565051').pack(pady=4)
+            self.neighSlider = tk.Scale(self.winDistance, from_= 0, to= self.n-1, orient= 'horizontal', bg= '#565051', relief='flat', bd=0)
+            self.neighSlider.set(min(8, self.n-1))
             self.neighSlider.pack(pady=4)
             
             self.buttonOkDistance = tk.Button(self.winDistance, image=  self.imageOk, activebackground= '#565051',command= lambda: self.Distclick(), bg= '#565051', relief='flat', highlightthickness=0, bd=0, width= 50)
@@ -383,22 +404,41 @@ class MainWindow:
             self.winDistanceInv.geometry("300x280+500+50")
             self.currentDistanceInv = tk.StringVar()
             self.labelDistInv = tk.Label(self.winDistanceInv, text= "Select Radius Distance:", bg= '#565051').pack(pady=4)
-            self.distanceSlider = tk.Scale(self.winDistanceInv, from_= self.minDist, to= self.maxDist, orient= 'horizontal', bg= '#565051', relief='flat', bd=0)
+            self.distanceSlider = self.radiusSlider(self.winDistanceInv)
             self.distanceSlider.pack(pady=4)
             self.labelpower = tk.Label(self.winDistanceInv, text= "Select Power:", bg= '#565051').pack(pady=4)
             self.powerSlider = tk.Scale(self.winDistanceInv, from_= 0, to= 10, orient= 'horizontal', bg= '#565051', relief='flat', bd=0)
             self.powerSlider.pack(pady=4)
-            self.labelNeighNumber = tk.Label(self.winDistanceInv, text= "Select Number of Neighbors:", bg= '#565051').pack(pady=4)
-            self.neighSlider = tk.Scale(self.winDistanceInv, from_= 1, to= self.n-1, orient= 'horizontal', bg= '#565051', relief='flat', bd=0)
+            self.labelNeighNumber = tk.Label(self.winDistanceInv, text= "Select Number of Neighbors (0: all in radius):", bg= '#565051').pack(pady=4)
+            self.neighSlider = tk.Scale(self.winDistanceInv, from_= 0, to= self.n-1, orient= 'horizontal', bg= '#565051', relief='flat', bd=0)
+            self.neighSlider.set(min(8, self.n-1))
             self.neighSlider.pack(pady=4)
             
             self.buttonOkDistanceInv = tk.Button(self.winDistanceInv, image= self.imageOk, activebackground= '#565051',command= lambda: self.DistInvclick(),bg= '#565051',  relief='flat', highlightthickness=0, bd=0, width= 50)
             self.buttonOkDistanceInv.pack(pady=4)         
     
+    def radiusSlider(self, master):
+        #The radius starts at the layer extent, where it cuts no k nearest
+        #neighbor link, in steps that suit the units of the layer
+        step = resolution(self.minDist, self.maxDist)
+        top = np.ceil(self.maxDist / step) * step
+        slider = tk.Scale(master, from_= np.floor(self.minDist / step) * step, to= top, resolution= step, orient= 'horizontal', bg= '#565051', relief='flat', bd=0)
+        slider.set(top)
+        return slider
+    
+    def allPairs(self):
+        #Every feature within the layer extent of every other is n^2 links
+        if self.neighN == 0 and self.testDist >= self.maxDist:
+            messagebox.showinfo("Moran's I:", 'All neighbors within the layer extent link every pair of features. Select a number of neighbors or a smaller radius.')
+            return True
+        return False
+    
     def Neighborclick(self):
         self.neighbormethod = self.currentNeighbor.get()
+        self.engine = core.ENGINES[core.ENGINE_LABELS.index(self.currentEngine.get())]
         self.neighN = self.neighSlider.get()
         self.bufferget = self.buffer.get()
+        self.snapget = self.snap.get()
         self.lfeat.set(f'{self.feat} / {self.method} / {self.neighbormethod} / N : {self.neighN} / B : {round(self.bufferget)}')
         self.button6.config(state='normal')
         self.winNeighbor.destroy()
@@ -407,7 +447,9 @@ class MainWindow:
     def Distclick(self):
         self.testDist = self.distanceSlider.get()
         self.neighN = self.neighSlider.get()
-        self.lfeat.set(f'{self.feat} / {self.method} / D: {round(self.testDist)} / N : {self.neighN}')
+        if self.allPairs():
+            return
+        self.lfeat.set(f'{self.feat} / {self.method} / D: {self.testDist:g} / N : {self.neighN}')
         self.button6.config(state='normal')
         self.winDistance.destroy()
         return(self.neighbormethod)
@@ -415,8 +457,10 @@ class MainWindow:
     def DistInvclick(self):
         self.testDist = self.distanceSlider.get()
         self.neighN = self.neighSlider.get()
+        if self.allPairs():
+            return
         self.power = self.powerSlider.get()
-        self.lfeat.set(f'{self.feat} / {self.method} / D: {round(self.testDist)} / N : {self.neighN} / p : {self.power}')
+        self.lfeat.set(f'{self.feat} / {self.method} / D: {self.testDist:g} / N : {self.neighN} / p : {self.power}')
         self.button6.config(state='normal')
         self.winDistanceInv.destroy()
         return(self.neighbormethod)
@@ -425,23 +469,50 @@ class MainWindow:
 #-------------------------- R E S U L T S   M E N U --------------------------#
 #-----------------------------------------------------------------------------# 
     def callwinResults(self):  
-        self.Permutations()
+        #Permutations are opt-in, the analytical inference takes one pass over the links
+        if self.inference == moran.INFERENCE[2]:
+            seed = self.getSeed()
+            self.startJob('Permutations', lambda progress: self.Permutations(seed, progress), self.showResults)
+        else:
+            self.startJob('Inference', lambda progress: self.Analytical(), self.showResults)
+        
+    def showResults(self, result):
+        if self.inference == moran.INFERENCE[2]:
+            self.plotPermutations()
         self.winResults = tk.Toplevel(self.master, bg= '#565051')
         self.winResults.geometry("700x600+200+50")
         
         self.text = ''
         
-        self.frame = tk.Frame(self.winResults, bg= '#565051')
-        self.frame.place(relx= 0, rely=0, relheight= 1, relwidth= 1)
+        self.resultsFrame = tk.Frame(self.winResults, bg= '#565051')
+        self.resultsFrame.place(relx= 0, rely=0, relheight= 1, relwidth= 1)
+        
+        self.screen = tk.Text(self.resultsFrame)
+        self.screen.place(relx= 0.02, rely=0.02, relheight= 0.3, relwidth= 0.95)
+        
+        self.lagbutton = tk.Button(self.resultsFrame, image= self.imageCalc, activebackground= '#565051', bg= '#565051', relief='flat', highlightthickness=0, bd=0, command=lambda:self.callwinCorrelogram())
+        self.lagbutton.place(relx = 0.17, rely= 0.88, relheight= 0.07, relwidth= 0.17)
+        tooltip.CreateToolTip(self.lagbutton, "Correlogram", 40, 45)
+        if self.method == self.methods[0]:
+            self.lagbutton.config(state= 'disabled')
+        
+        self.crossbutton = tk.Button(self.resultsFrame, image= self.imageResults, activebackground= '#565051', bg= '#565051', relief='flat', highlightthickness=0, bd=0, command=lambda:self.callwinBivariate())
+        self.crossbutton.place(relx = 0.0, rely= 0.88, relheight= 0.07, relwidth= 0.17)
+        tooltip.CreateToolTip(self.crossbutton, "Bivariate Moran's I of attribute pairs", 40, 45)
+        
+        self.localbutton = tk.Button(self.resultsFrame, image= self.imageDistance, activebackground= '#565051', bg= '#565051', relief='flat', highlightthickness=0, bd=0, command=lambda:self.localMoransI())
+        self.localbutton.place(relx = 0.34, rely= 0.88, relheight= 0.07, relwidth= 0.17)
+        tooltip.CreateToolTip(self.localbutton, "Local Moran's I clusters", 40, 45)
         
-        self.screen = tk.Text(self.frame)
-        self.screen.place(relx= 0.02, rely=0.02, relheight= 0.82, relwidth= 0.95)
+        self.screenbutton = tk.Button(self.resultsFrame, image= self.imageAttrTable, activebackground= '#565051', bg= '#565051', relief='flat', highlightthickness=0, bd=0, command=lambda:self.screenAttributes())
+        self.screenbutton.place(relx = 0.51, rely= 0.88, relheight= 0.07, relwidth= 0.17)
+        tooltip.CreateToolTip(self.screenbutton, "Moran's I of all attributes", 40, 45)
         
-        self.savebutton = tk.Button(self.frame, image= self.imageSave, activebackground= '#565051', bg= '#565051', relief='flat', highlightthickness=0, bd=0, command=lambda:self.savetxt())
+        self.savebutton = tk.Button(self.resultsFrame, image= self.imageSave, activebackground= '#565051', bg= '#565051', relief='flat', highlightthickness=0, bd=0, command=lambda:self.savetxt())
         self.savebutton.place(relx = 0.68, rely= 0.88, relheight= 0.07, relwidth= 0.17)
         tooltip.CreateToolTip(self.savebutton, "Save results", 40, 45)
     
-        self.closebutton = tk.Button(self.frame, image= self.imageBack, activebackground= '#565051', bg= '#565051', relief='flat', highlightthickness=0, bd=0, command=lambda:self.winResults.destroy())
+        self.closebutton = tk.Button(self.resultsFrame, image= self.imageBack, activebackground= '#565051', bg= '#565051', relief='flat', highlightthickness=0, bd=0, command=lambda:self.winResults.destroy())
         self.closebutton.place(relx = 0.85, rely= 0.88, relheight= 0.07, relwidth= 0.12)
         tooltip.CreateToolTip(self.closebutton, "Back", 40, 45)
     
@@ -453,172 +524,150 @@ class MainWindow:
         
         self.screen.configure(wrap= 'none', yscrollcommand=self.scrollbar2.set, xscrollcommand=self.scrollbar3.set) 
         
-        self.Cs = pd.DataFrame(self.Cs)
-        self.Ws = pd.DataFrame(self.Ws)
-        self.devp = pd.DataFrame(self.devp)
+        #Weight tables are paged, only the visible neighbor lists are formatted
+        self.neighborView = matrixview.NeighborView(self.resultsFrame, self.Cs, self.Ws, self.dev, self.polygons.index)
+        self.neighborView.place(relx= 0.02, rely=0.34, relheight= 0.52, relwidth= 0.95)
         
         if self.method == self.methods[0]:
-            self.text = f"-Feature: {self.feat}\n-Method: {self.method} - {self.neighbormethod}\n-Number of neighbors: {self.neighN}\n-Buffer: {self.bufferget}\n-Moran's I: {round(self.MoransI, 5)}\n-E(I): {round(self.EI,5)}\n-μ: {round(self.MIm, 5)}\n-σ: {round(self.MIstd, 5)}\n-z: {round(self.Zscore, 3)}\n-P value: 0.001\n-Weight Table:\n{np.round(self.Cs,decimals=1)}\n-Normalized Weight Table:\n{np.round(self.Ws,decimals=1)}\n-Deviation Table:\n{np.round(self.devp,decimals=1)}\n"                    
+            self.text = f"-Feature: {self.feat}\n-Method: {self.method} - {self.neighbormethod} ({core.ENGINE_LABELS[core.ENGINES.index(self.engine)]})\n-Number of neighbors: {self.neighN}\n-Buffer: {self.bufferget}\n-Snap: {self.snapget}\n"
         elif self.method == self.methods[1]:
-            self.text = f"-Feature: {self.feat}\n-Method: {self.method} - {round(self.testDist)}m\n-Number of neighbors: {self.neighN}\n-Moran's I: {round(self.MoransI, 5)}\n-E(I): {round(self.EI,5)}\n-μ: {round(self.MIm, 5)}\n-σ: {round(self.MIstd, 5)}\n-z: {round(self.Zscore, 3)}\n-P value: 0.001\n-Weight Table:\n{np.round(self.Cs,decimals=1)}\n-Normalized Weight Table:\n{np.round(self.Ws,decimals=1)}\n-Deviation Table:\n{np.round(self.devp,decimals=1)}\n"                           
+            self.text = f"-Feature: {self.feat}\n-Method: {self.method} - {self.testDist:g}\n-Number of neighbors: {self.neighN}\n"
         elif self.method == self.methods[2]:
-            self.text = f"-Feature: {self.feat}\n-Method: {self.method} - {round(self.testDist)}m\n-Power: {self.power}\n-Number of neighbors: {self.neighN}\n-Moran's I: {round(self.MoransI, 5)}\n-E(I): {round(self.EI,5)}\n-μ: {round(self.MIm, 5)}\n-σ: {round(self.MIstd, 5)}\n-z: {round(self.Zscore, 3)}\n-P value: 0.001\n-Weight Table:\n{np.round(self.Cs,decimals=1)}\n-Normalized Weight Table:\n{np.round(self.Ws,decimals=1)}\n-Deviation Table:\n{np.round(self.devp,decimals=1)}\n"                    
+            self.text = f"-Feature: {self.feat}\n-Method: {self.method} - {self.testDist:g}\n-Power: {self.power}\n-Number of neighbors: {self.neighN}\n"
+        
+        self.text += f"-Moran's I: {round(self.MoransI, 5)}\n-Inference: {self.inference}\n-E(I): {round(self.EI,5)}\n"
+        if self.inference == moran.INFERENCE[2]:
+            self.text += f"-μ: {round(self.MIm, 5)}\n-σ: {round(self.MIstd, 5)}\n-z: {round(self.Zscore, 3)}\n-Permutations: {self.perm}\n-P value: {round(self.pvalue, 5)}\n"
+        else:
+            self.text += f"-Var(I): {self.VI:.5g}\n-z: {round(self.Zscore, 3)}\n-P value (two sided): {self.pvalue:.5g}\n"
+        self.text += f"-Links: {self.Cs.nnz}\n"
+        self.text += f"-Stages:\n{self.stages.text()}"
+        self.stages.dump()
         
         self.screen.insert(tk.INSERT, self.text)
         self.screen.config(state= 'disabled') 
     
     def savetxt(self): 
-        self.file_name = tk.filedialog.asksaveasfilename(parent= self.master)
+        self.file_name = filedialog.asksaveasfilename(parent= self.master, filetypes= [("Edge list", "*.csv"), ("GAL / GWT", "*.gal"), ("Compressed binary", "*.npz"), ("Parquet edge list", "*.parquet")])
         if self.file_name:  
+            #The weights format follows the chosen extension, edge list by default
+            base, ext = os.path.splitext(self.file_name)
+            fmt = ext[1:].lower()
+            if fmt in ('csv', 'gal', 'npz', 'parquet'):
+                self.file_name = base
+            else:
+                fmt = 'csv'
+            
             self.pos = f'-Path: {self.file_name} \n'
             with open(f'{self.file_name}.txt', 'w') as file:
                 file.write(self.pos)
                 file.write(self.text)
-            self.Cs.to_csv(f'{self.file_name}W.csv', header=None, index=None, sep=',', mode='a')
-            self.Ws.to_csv(f'{self.file_name}NW.csv', header=None, index=None, sep=',', mode='a')
-            self.devp.to_csv(f'{self.file_name}D.csv', header=None, index=None, sep=',', mode='a')
-            tk.messagebox.showinfo("Moran's I:", 'Result files saved successfully!')
+            core.exportWeights(self.file_name, self.Cs, self.Ws, fmt, self.polygons.index, os.path.basename(self.filename))
+            if self.lisa is not None:
+                self.lisa.to_csv(f'{self.file_name}L.csv')
+            if self.lags is not None:
+                self.lags.to_csv(f'{self.file_name}C.csv', index= False)
+            if self.cross is not None:
+                self.cross.to_csv(f'{self.file_name}B.csv', index= False)
+            messagebox.showinfo("Moran's I:", 'Result files saved successfully!')
             
 #-----------------------------------------------------------------------------#
 #------------------ C A L C U L A T E   M O R A N S  I------------------------#
 #-----------------------------------------------------------------------------#
     def calcMoransI(self):
+        self.lisa = None
+        self.lags = None
+        self.cross = None
         if self.method == self.methods[0]:
-            self.NeighborMoransI()
-            self.MoransIscatterPlot()
-            self.MIreps = [self.MoransI]
+            job = self.NeighborMoransI
         
         elif self.method == self.methods[1]:
-            self.DistanceMoransI()
-            self.MoransIscatterPlot()
-            self.MIreps = [self.MoransI]
+            job = self.DistanceMoransI
     
         elif self.method == self.methods[2]:
-            self.IDWMoransI()
-            self.MoransIscatterPlot()
-            self.MIreps = [self.MoransI]
+            job = self.IDWMoransI
+        
+        self.startJob('Spatial weights', job, self.showMoransI)
         
+    def showMoransI(self, result):
+        self.MoransIscatterPlot()
         self.button7.config(state= 'normal')
 
 #-----------------------------------------------------------------------------#
 #---------------------- N E I G H B O R   P O L Y G O N S --------------------#
 #-----------------------------------------------------------------------------#
-    def NeighborMoransI(self): 
+    def NeighborMoransI(self, progress=None): 
         self.ft = np.array(self.polygons[self.feat])
-        self.polygons['geometry']= self.polygons.buffer(self.bufferget)
             
-        #Contiguity table      
-        self.xneigh = np.arange(len(self.polygons))
-        if self.neighbormethod == 'Rook':
-            self.polygs = np.array(self.polygons.geometry.apply(lambda g: self.polygons.geometry.intersects(g)))
-        else:
-            self.polygs = np.array(self.polygons.geometry.apply(lambda g: self.polygons.geometry.touches(g)))
-        self.polygs = self.polygs.astype(int)
-        np.fill_diagonal(self.polygs, 0)
-        self.Cs = np.where( (self.polygs[self.xneigh,:] == 1) & (np.cumsum(self.polygs, axis=1)<= self.neighN), 1, 0)
-        
-        #Weight Table
-        self.Rs = self.Cs.sum(axis=1)[:,None]
-        
-        #self.Ws = np.divide(self.Cs, self.Rs, out=np.zeros_like(self.Cs), where=self.Rs!=0)
-  
-        with np.errstate(divide='ignore', invalid='ignore'):
-          self.Ws = np.true_divide(self.Cs, self.Rs)
-          self.Ws[self.Ws == np.inf] = 0
-          self.Ws = np.nan_to_num(self.Ws)
+        #Contiguity and weight table, the layer is hashed once for the cache
+        if self.layerHash is None:
+            self.layerHash = cache.geometryHash(self.polygons.geometry.values)
+        with self.stages.stage('weights') as record:
+            self.Cs, self.Ws = core.buildWeights(self.polygons, self.method, self.neighN, self.neighbormethod, self.bufferget, store= self.store, layer= self.layerHash, progress= progress, engine= self.engine, snap= self.snapget)
+            record['nnz'] = self.Cs.nnz
           
-        self.MIcalc()
+        with self.stages.stage('statistic') as record:
+            self.MIcalc()
+            record['n'] = len(self.ft)
 
 #-----------------------------------------------------------------------------#
 #---------------------- C E N T R O I D S   D I S T A N C E ------------------#
 #-----------------------------------------------------------------------------#
-    def DistanceMoransI(self):     
+    def DistanceMoransI(self, progress=None):     
         #centroids.to_file("centroids.shp")
         self.ft = np.array(self.polygons[self.feat])
             
-        #Distances between neighbors      
-        self.mins = np.argsort(self.dists, 1)[:, 0:self.neighN + 1]
-     
-        #Weight calculation
-        self.mindists = np.take_along_axis(self.dists, self.mins, 1)
-    
-        self.xrange = np.arange(self.n)     
-        self.Cs = np.where( (self.dists > 0) & (np.isin(self.dists[self.xrange,:], self.mindists[self.xrange,:])), 1, 0 )
-        self.Rs = self.Cs.sum(axis=1)[:,None]
-
-        #Weight Table
-        #self.Cs = np.array(self.Cs).reshape((self.n, self.n))       
-        #Normalize Weight Table
-        #self.Ws = self.Cs / self.Cs.sum(axis=1)[:,None]            
-        #self.Ws = np.divide(self.Cs, self.Rs, out=np.zeros_like(self.Cs), where=self.Rs!=0)
- 
-        #Normalize weight table
-        with np.errstate(divide='ignore', invalid='ignore'):
-           self.Ws = np.true_divide(self.Cs, self.Rs)
-           self.Ws[self.Ws == np.inf] = 0
-           self.Ws = np.nan_to_num(self.Ws)
+        #Nearest neighbors within the radius, cut from the kept candidates
+        with self.stages.stage('weights') as record:
+            self.Cs, self.Ws = core.buildWeights(self.polygons, self.method, self.neighN, radius= self.testDist, candidates= self.candidates, progress= progress)
+            record['nnz'] = self.Cs.nnz
            
-        self.MIcalc()
+        with self.stages.stage('statistic') as record:
+            self.MIcalc()
+            record['n'] = len(self.ft)
             
 #-----------------------------------------------------------------------------#
 #-------------------- I N V E R S E   D I S T A N C E ------------------------#
 #-----------------------------------------------------------------------------#
-    def IDWMoransI(self):
+    def IDWMoransI(self, progress=None):
         #centroids.to_file("centroids.shp")
         self.ft = np.array(self.polygons[self.feat])
         
-        #Distances between neighbors      
-        self.mins = np.argsort(self.dists, 1)[:, 0:self.neighN + 1]          
-        
-        #Weight calculation
-        self.mindists = np.take_along_axis(self.dists, self.mins, 1)
-        self.xrange = np.arange(self.n)
-        
-        self.idp = np.divide(1, self.dists**self.power, where=self.dists!=0)  
-        self.Cs = np.where( (self.dists > 0) & (np.isin(self.dists[self.xrange,:], self.mindists[self.xrange,:])), self.idp, 0 )
-       
-        self.Rs = self.Cs.sum(axis=1)[:,None]
-        
-        #Weight Table
-        #self.Cs = np.array(self.Cs).reshape((self.n, self.n))
-        #self.Ws = np.divide(self.Cs, self.Rs, out=np.zeros_like(self.Cs), where=self.Rs!=0)
-        
-        #Normalize weight table
-        with np.errstate(divide='ignore', invalid='ignore'):
-           self.Ws = np.true_divide(self.Cs, self.Rs)
-           self.Ws[self.Ws == np.inf] = 0
-           self.Ws = np.nan_to_num(self.Ws)
+        #Inverse distance weights of the nearest neighbors cut from the kept candidates
+        with self.stages.stage('weights') as record:
+            self.Cs, self.Ws = core.buildWeights(self.polygons, self.method, self.neighN, radius= self.testDist, power= self.power, candidates= self.candidates, progress= progress)
+            record['nnz'] = self.Cs.nnz
         
-        self.MIcalc()       
+        with self.stages.stage('statistic') as record:
+            self.MIcalc()
+            record['n'] = len(self.ft)       
+    
+    def clearRun(self):
+        #State kept between runs of the same layer, cleared when the layer changes
+        self.dev = None
+        self.candidates = None
+        self.layerHash = None
     
     def MIcalc(self):
-        #Residuals calculation
-        self.dev = self.ft - np.mean(self.ft)
-        
-        #Square residuals
-        self.dev2 = self.dev**2
+        #Residuals and their sum of squares only change with the attribute
+        if self.dev is None:
+            self.dev = moran.deviations(self.ft)
+            self.Sdev2 = self.dev @ self.dev
         
-        #Sum of square residuals
-        self.Sdev2 = np.sum(self.dev2)
-         
-        #Cartesian product of residuals
-        deva, devb = np.meshgrid(self.dev, self.dev)
-        self.devp = deva * devb
-        self.wft = self.Ws * self.devp
-        
-        #Sum of cartesian product
-        self.Swtf = np.sum(self.wft)
+        #Weighted sum of residual products over the neighbor links
+        self.Swtf = moran.crossProduct(self.dev, self.Ws)
         
         #Moran's index 
-        self.MoransI = self.Swtf / self.Sdev2
+        self.MoransI = moran.scale(self.Ws) * self.Swtf / self.Sdev2
         #self.MoransI = round(self.MoransI, 5)
         
 #-----------------------------------------------------------------------------#
 #------------------ M O R A N S   I   S C A T T E R   P L O T ----------------#
 #-----------------------------------------------------------------------------#
     def MoransIscatterPlot(self):
+        plt = pyplot()
         self.zft = self.dev / np.std(self.ft)
-        self.Zw = np.sum(self.Ws * self.zft, axis=1)  
+        self.Zw = self.Ws @ self.zft  
         
         minzs2 = np.min(self.zft)
         maxzs2 = np.max(self.zft)
@@ -643,31 +692,40 @@ class MainWindow:
 #-----------------------------------------------------------------------------#    
 #------------------------- P E R M U T A T I O N S ---------------------------#      
 #-----------------------------------------------------------------------------#  
-    def Permutations(self):  
+    def Permutations(self, seed=None, progress=None):  
         self.originalMI = self.MoransI
-        for i in range(999):
-            self.ft = np.random.permutation(self.ft)       
-            self.MIcalc()
-            self.MIreps.append(self.MoransI)
+        with self.stages.stage('permutations') as record:
+            summary, self.MIreps = core.permutationInference(self.dev, self.Ws, self.originalMI, self.perm, seed, self.workers, progress)
+            record.update(permutations= self.perm, workers= self.workers)
            
-        self.MIreps = np.array(self.MIreps)    
-        self.MIm = np.mean(self.MIreps)
-        self.MIstd = np.std(self.MIreps)
-        self.EI = -1/(len(self.ft) - 1)
-        self.MIreps = np.round(self.MIreps, decimals=5)
-        
-        self.Zscore = (self.originalMI - self.EI) / self.MIstd
-        self.pvalue = 0.001
-        
+        self.MIm = summary['mean']
+        self.MIstd = summary['std']
+        self.EI = summary['EI']
+        self.Zscore = summary['z']
+        self.pvalue = summary['p']
+        
+    def Analytical(self):
+        #Closed form moments from the weight sums S0, S1, S2 and the kurtosis
+        with self.stages.stage('analytical'):
+            summary = moran.analytical(self.dev, self.Ws, self.MoransI)
+        key = 'norm' if self.inference == moran.INFERENCE[1] else 'rand'
+        self.EI = summary['EI']
+        self.VI = summary[f'VI_{key}']
+        self.Zscore = summary[f'z_{key}']
+        self.pvalue = summary[f'p_{key}']
+        
+    def plotPermutations(self):
+        plt = pyplot()
         fig = plt.figure(figsize= (7,4), dpi=100)
         ax = fig.gca()
    
-        plt.axvline(x= self.MIreps[0], lw= 2, color='r')
+        plt.axvline(x= self.originalMI, lw= 2, color='r')
         plt.hist(self.MIreps, density= True, color= '#438D80', alpha= 0.8)
         xt = plt.xticks()[0]  
         xmin, xmax = min(xt), max(xt)  
         lnspc = np.linspace(xmin, xmax, len(self.MIreps))
         #m, s = stats.norm.fit(self.MIreps)
+        from scipy import stats
         pdf_g = stats.norm.pdf(lnspc, self.MIm, self.MIstd)
         plt.plot(lnspc, pdf_g, label="Norm", color= '#CD7F32')            
         
@@ -677,10 +735,204 @@ class MainWindow:
         
         plt.show()
 
+    def getSeed(self):
+        return int(self.seed.get()) if self.seed.get().strip() else None
+
+#-----------------------------------------------------------------------------#
+#----------------------- L O C A L   M O R A N S   I -------------------------#
+#-----------------------------------------------------------------------------#
+    def localMoransI(self):
+        polygons, feat, Ws, nperm, seed = self.polygons, self.feat, self.Ws, self.perm, self.getSeed()
+        job = lambda progress: core.local(polygons, feat, Ws, nperm, seed, self.workers, progress= progress, stages= self.stages)
+        self.startJob("Local Moran's I", job, self.plotLocalMoransI)
+        
+    def plotLocalMoransI(self, lisa):
+        plt = pyplot()
+        self.lisa = lisa
+        colors = {'High-High': '#D7191C', 'Low-Low': '#2C7BB6', 'High-Low': '#FDAE61', 'Low-High': '#ABD9E9', 'Not significant': '#EEEEEE'}
+        
+        fig = plt.figure(figsize= (6,5), dpi=100)
+        ax = fig.gca()
+        ax.set_aspect('equal')
+        ax.axis('off')
+        self.polygons.plot(ax= ax, color= self.lisa['cluster'].map(colors), edgecolor= 'k', linewidth= 0.2)
+        for label, color in colors.items():
+            ax.scatter([], [], color= color, marker= 's', label= f"{label} ({np.sum(self.lisa['cluster'] == label)})")
+        plt.legend(loc= 'upper left', bbox_to_anchor= (1, 1), fontsize= 8)
+        plt.title(f"LISA clusters : {self.feat}", fontsize=14)
+        plt.show()
+
+#-----------------------------------------------------------------------------#
+#--------------------------- C O R R E L O G R A M ---------------------------#
+#-----------------------------------------------------------------------------#
+    def callwinCorrelogram(self):
+        self.winLags = tk.Toplevel(self.master, bg= '#565051')
+        self.winLags.geometry("300x220+500+50")
+        self.lagType = tk.StringVar(value= 'k nearest neighbors')
+        self.lagValues = tk.StringVar(value= '2 4 8 16')
+        self.labelLagType = tk.Label(self.winLags, text= "Lags:", bg= '#565051').pack(pady=4)
+        self.comboLags = ttk.Combobox(self.winLags, values= ['k nearest neighbors', 'Distance bands'], textvariable= self.lagType, state= 'readonly')
+        self.comboLags.pack(pady=4)
+        self.labelLagValues = tk.Label(self.winLags, text= "k values or band edges:", bg= '#565051').pack(pady=4)
+        self.entryLags = tk.Entry(self.winLags, textvariable= self.lagValues, bd=2, justify= 'c', width= 25)
+        self.entryLags.pack(pady=4)
+        
+        self.buttonOkLags = tk.Button(self.winLags, image= self.imageOk, activebackground= '#565051',command= lambda: self.Lagsclick(), bg= '#565051', relief='flat', highlightthickness=0, bd=0, width= 50)
+        self.buttonOkLags.pack(pady=6)
+        
+    def Lagsclick(self):
+        by = 'k' if self.lagType.get() == 'k nearest neighbors' else 'band'
+        lags = [float(lag) for lag in self.lagValues.get().replace(',', ' ').split()]
+        self.winLags.destroy()
+        if not lags:
+            return
+        #Cumulative k lags keep the radius of the run, bands replace it
+        polygons, feat, method, radius, power, nperm, seed = self.polygons, self.feat, self.method, self.testDist, self.power, self.perm, self.getSeed()
+        job = lambda progress: core.correlogram(polygons, feat, method, lags, by, radius, power, nperm, seed, self.workers, progress, self.candidates, self.stages)
+        self.startJob('Correlogram', job, self.plotCorrelogram)
+        
+    def plotCorrelogram(self, lags):
+        plt = pyplot()
+        self.lags = lags
+        plt.figure(figsize= (7,4), dpi=100)
+        
+        plt.axhline(y= -1 / (len(self.polygons) - 1), lw= 1, color='k', ls= '--')
+        if 'std' in lags:
+            plt.fill_between(lags['lag'], lags['mean'] - 1.96 * lags['std'], lags['mean'] + 1.96 * lags['std'], color= '#438D80', alpha= 0.3)
+        plt.plot(lags['lag'], lags['I'], color= '#CD7F32', marker= 'o')
+        
+        plt.xlabel('Lag (k)' if 'from' not in lags else 'Distance band')
+        plt.ylabel("Moran's I")
+        plt.title(f"Correlogram : {self.feat}", fontsize=14)
+        plt.show()
+
+#-----------------------------------------------------------------------------#
+#----------------------- A L L   A T T R I B U T E S -------------------------#
+#-----------------------------------------------------------------------------#
+    def screenAttributes(self):
+        #Every numeric attribute against the weight table already built
+        filename, atr, index, Ws, nperm, seed, stages = self.filename, self.atr, self.polygons.index, self.Ws, self.perm, self.getSeed(), self.stages
+        
+        def job(progress):
+            with stages.stage('all attributes') as record:
+                table = core.loadColumns(filename, atr).loc[index]
+                feats = core.numericAttributes(table, atr)
+                record.update(attributes= len(feats), permutations= nperm)
+                return core.screen(table, feats, Ws, nperm, seed, self.workers, progress)
+        self.startJob('All attributes', job, self.showScreen)
+        
+    def showScreen(self, table):
+        self.screenTable = table
+        self.feats = list(table['feature'])
+        self.winScreen = tk.Toplevel(self.master, bg= '#565051')
+        self.winScreen.geometry("700x400+300+50")         
+        self.winScreen.title("Moran's I of all attributes")
+        
+        self.screenFrame = tk.Frame(self.winScreen, bg= '#565051')
+        self.screenFrame.place(relx= 0, rely=0, relheight= 1, relwidth= 1)
+        
+        from pandastable import Table
+        self.ptScreen = Table(self.screenFrame, dataframe= self.screenTable.round(5), showtoolbar=True, showstatusbar=True)
+        self.ptScreen.show()
+
+#-----------------------------------------------------------------------------#
+#-------------------- B I V A R I A T E   M O R A N S   I --------------------#
+#-----------------------------------------------------------------------------#
+    def callwinBivariate(self):
+        self.winCross = tk.Toplevel(self.master, bg= '#565051')
+        self.winCross.geometry("300x320+500+50")
+        self.labelCross = tk.Label(self.winCross, text= "Select Attributes:", bg= '#565051').pack(pady=6)
+        self.listCross = tk.Listbox(self.winCross, selectmode= 'multiple', exportselection= False, height= 12)
+        for feat in self.atr:
+            self.listCross.insert(tk.END, feat)
+        self.listCross.pack(pady=4, fill= tk.X, padx= 20)
+        
+        self.buttonOkCross = tk.Button(self.winCross, image= self.imageOk, activebackground= '#565051',command= lambda: self.Crossclick(), bg= '#565051', relief='flat', highlightthickness=0, bd=0, width= 50)
+        self.buttonOkCross.pack(pady=6)
+        
+    def Crossclick(self):
+        feats = [self.atr[i] for i in self.listCross.curselection()]
+        self.winCross.destroy()
+        if len(feats) < 2:
+            messagebox.showinfo("Moran's I:", 'Select at least two attributes.')
+            return
+        #Every pair in one batched product over the weight table already built
+        filename, index, Ws, nperm, seed, stages = self.filename, self.polygons.index, self.Ws, self.perm, self.getSeed(), self.stages
+        
+        def job(progress):
+            table = core.loadColumns(filename, feats).loc[index]
+            return core.bivariate(table, core.numericAttributes(table, feats), Ws, nperm, seed, self.workers, progress, stages)
+        self.startJob("Bivariate Moran's I", job, self.plotBivariate)
+        
+    def plotBivariate(self, cross):
+        plt = pyplot()
+        self.cross = cross
+        feats = list(dict.fromkeys(cross['x']))
+        I = cross['I'].to_numpy().reshape(len(feats), len(feats))
+        
+        fig = plt.figure(figsize= (6,5), dpi=100)
+        ax = fig.gca()
+        image = ax.imshow(I, cmap= 'RdBu_r', vmin= -np.max(np.abs(I)), vmax= np.max(np.abs(I)))
+        for (i, j), value in np.ndenumerate(I):
+            mark = '*' if 'p' in cross and cross['p'].iloc[i * len(feats) + j] <= 0.05 else ''
+            ax.text(j, i, f'{value:.2f}{mark}', ha= 'center', va= 'center', fontsize= 8)
+        ax.set_xticks(range(len(feats)), feats, rotation= 45, ha= 'right')
+        ax.set_yticks(range(len(feats)), feats)
+        ax.set_xlabel('Spatial lag of')
+        fig.colorbar(image, ax= ax)
+        plt.title("Bivariate Moran's I (* p ≤ 0.05)", fontsize=14)
+        plt.tight_layout()
+        plt.show()
+
+#-----------------------------------------------------------------------------#
+#------------------------ B A C K G R O U N D   J O B S ----------------------#
+#-----------------------------------------------------------------------------#
+    def progressWidgets(self):
+        self.worker = None
+        self.stages = instrument.Stages()
+        self.mapView = None
+        self.progressBar = ttk.Progressbar(self.frame, mode= 'determinate')
+        self.cancelButton = tk.Button(self.frame, text= 'Cancel', bg= '#565051', activebackground= '#565051', relief='flat', highlightthickness=0, bd=0, command=lambda: self.cancelJob())
+        tooltip.CreateToolTip(self.cancelButton, "Cancel the running computation", 40, 45)
+        
+    def startJob(self, text, job, done):
+        #job(progress) runs on a worker thread and must not touch any widget,
+        #done(result) runs on the main loop once it has finished
+        if self.worker is not None:
+            return
+        self.master.title(f" Moran's I - {text} ")
+        self.master.config(cursor= 'watch')
+        self.progressBar.config(value= 0, maximum= 1)
+        self.progressBar.place(relx= 0.15, rely= 0.172, relwidth= 0.6, relheight= 0.015)
+        self.cancelButton.place(relx= 0.76, rely= 0.165, relwidth= 0.09, relheight= 0.028)
+        self.worker = worker.Worker(self.master, job, done= lambda result: self.endJob(done, result), progress= self.showProgress,
+                                    failed= self.failJob, cancelled= lambda: self.endJob())
+        
+    def showProgress(self, done, total):
+        self.progressBar.config(value= done, maximum= max(total, 1))
+        
+    def cancelJob(self):
+        if self.worker is not None:
+            self.worker.cancel()
+        
+    def endJob(self, done=None, result=None):
+        self.worker = None
+        self.progressBar.place_forget()
+        self.cancelButton.place_forget()
+        self.master.title(" Moran's I ")
+        self.master.config(cursor= '')
+        if done is not None:
+            done(result)
+            
+    def failJob(self, error):
+        self.endJob()
+        messagebox.showerror("Moran's I:", f'{type(error).__name__}: {error}')
+
 #-----------------------------------------------------------------------------#
 #--------------------- R E S E T   A P P L I C A T I O N ---------------------#
 #-----------------------------------------------------------------------------#
     def ResetApp(self):
+        self.cancelJob()
         self.frame.destroy()
         self.frame = tk.Frame(self.master, bg= '#565051')
         self.frame.place(relheight=1, relwidth=1)
@@ -691,13 +943,19 @@ class MainWindow:
         self.feat = ''
         self.method = ''
         self.neighbormethod = ''
+        self.engine = core.ENGINES[0]
         self.neighN = 0
         self.buffer = tk.DoubleVar(value= 0)
+        self.snap = tk.DoubleVar(value= 0)
         self.Dist = 0
         self.power = 0
         self.MoransI = 0
         self.outlcheck = False
-        self.perm = 0
+        self.perm = 999
+        self.inference = moran.INFERENCE[0]
+        self.seed = tk.StringVar(value='')
+        self.workers = os.cpu_count() or 1
+        self.store = cache.WeightsCache()
         
         self.button = tk.Button(self.frame, image= self.imageFolder, command=lambda: self.readshp(), bg= '#565051', activebackground= '#565051', relief='flat', highlightthickness=0, bd=0)
         self.button.place(relx=0.015, rely=0, relwidth= 0.12, relheight= 0.1)
@@ -730,6 +988,7 @@ class MainWindow:
         self.button8 = tk.Button(self.frame, image= self.imageRefresh, state= 'disabled', bg= '#565051', command=lambda: self.ResetApp(), activebackground= '#565051', relief='flat', highlightthickness=0, bd=0)
         self.button8.place(relx=0.855, rely=0, relwidth= 0.12, relheight= 0.1)
         tooltip.CreateToolTip(self.button8, "Reset application", 40, 45)   
+        self.progressWidgets()
 #-----------------------------------------------------------------------------#
 
 #-----------------------------------------------------------------------------#
@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+#+----------+-----------------------------------------------------------------+
+#|   TITLE  | Moran's Index Calculator - Command Line                         |
+#+----------+-----------------------------------------------------------------+
+#|  DETAILS |Headless batch entry point. Runs the same core as the GUI and    |
+#|          |writes the results as JSON.                                      |
+#+----------+-----------------------------------------------------------------+
+#|  EXAMPLE |python MoransIcli.py layer.shp -a POP -m Distance -k 6 -o r.json  |
+#+----------+-----------------------------------------------------------------+
+
+import argparse, json, logging, os, sys
+import numpy as np
+import pandas as pd
+import cache, core, instrument
+
+
+
+def parser():
+    p = argparse.ArgumentParser(description= "Moran's I spatial autocorrelation of a polygon layer")
+    p.add_argument('file', help= 'polygon layer (shapefile or any format geopandas reads)')
+    p.add_argument('-a', '--attribute', nargs= '+', required= True, help= "attribute column(s), 'all' for every numeric attribute")
+    p.add_argument('-m', '--method', choices= core.METHODS, default= core.METHODS[0])
+    p.add_argument('-c', '--contiguity', choices= core.NEIGHBOR_METHODS, default= core.NEIGHBOR_METHODS[0])
+    p.add_argument('--engine', choices= core.ENGINES, default= core.ENGINES[0], help= 'contiguity definition, predicate (Rook: intersects, Queen: touches) or vertex (Rook: shared edge, Queen: shared vertex, faster on clean layers)')
+    p.add_argument('-k', '--neighbors', type= int, default= 8, help= 'number of neighbors (0: all within radius)')
+    p.add_argument('-b', '--buffer', type= float, default= 0, help= 'contiguity buffer size (predicates, the vertex engine falls back to them)')
+    p.add_argument('--snap', type= float, default= 0, help= 'vertex engine snapping grid size, 0 hashes the exact vertices')
+    p.add_argument('-r', '--radius', type= float, default= np.inf, help= 'distance band radius')
+    p.add_argument('-p', '--power', type= float, default= 1, help= 'inverse distance power')
+    p.add_argument('-n', '--permutations', type= int, default= 0, help= 'permutation test (opt-in), 0 keeps only the analytical inference')
+    p.add_argument('-s', '--seed', type= int, default= None)
+    p.add_argument('-w', '--workers', type= int, default= os.cpu_count() or 1)
+    p.add_argument('-l', '--local', default= None, help= "CSV file for the local Moran's I (LISA) of every feature")
+    p.add_argument('--alpha', type= float, default= 0.05, help= 'significance level of the LISA clusters (needs permutations)')
+    p.add_argument('-g', '--correlogram', default= None, metavar= 'CSV', help= "CSV file for Moran's I at every lag (distance methods)")
+    p.add_argument('--lags', type= float, nargs= '+', default= [2, 4, 8, 16], help= 'correlogram lags, k values or distance band edges')
+    p.add_argument('--lag-type', choices= ['k', 'band'], default= 'k', help= 'k nearest neighbors or distance bands')
+    p.add_argument('-x', '--bivariate', default= None, metavar= 'CSV', help= "CSV file for the bivariate Moran's I of every pair of attributes")
+    p.add_argument('-e', '--export-weights', default= None, metavar= 'BASE', help= 'write the weight tables as BASE + W/NW files')
+    p.add_argument('-f', '--weights-format', choices= ['csv', 'gal', 'npz', 'parquet'], default= 'csv', help= 'edge list csv/parquet, GAL/GWT or compressed npz')
+    p.add_argument('--cache-dir', default= cache.CACHE_DIR, help= 'weights cache folder')
+    p.add_argument('--no-cache', action= 'store_true', help= 'always build the weights from scratch')
+    p.add_argument('-v', '--verbose', action= 'store_true', help= 'log the time and traced memory of every stage')
+    p.add_argument('--profile', default= instrument.PROFILE, metavar= 'FILE', help= 'write a cProfile profile of the stages (pstats format)')
+    p.add_argument('-o', '--output', default= '-', help= 'results file, JSON or .csv table (default: JSON on stdout)')
+    return p
+
+def main(argv=None):
+    args = parser().parse_args(argv)
+    if args.verbose:
+        logging.basicConfig(level= logging.INFO, format= '%(message)s')
+    if args.method in core.METHODS[1:] and args.neighbors == 0 and not np.isfinite(args.radius):
+        sys.exit('-k 0 links every pair of features, give a finite --radius')
+    stages = instrument.Stages(memory= args.verbose, profile= args.profile)
+    feats = core.layerAttributes(args.file) if args.attribute == ['all'] else args.attribute
+    missing = [feat for feat in feats if feat not in core.layerFields(args.file)]
+    if missing:
+        sys.exit(f"Attribute(s) {', '.join(missing)} not found, available: {', '.join(core.layerAttributes(args.file))}")
+    
+    #Only the analysed columns are read, distance methods keep just the centroids
+    with instrument.stage(stages, 'load') as record:
+        polygons = core.loadLayer(args.file, feats, centroids= args.method != core.METHODS[0])
+        record['n'] = len(polygons)
+    if args.attribute == ['all']:
+        feats = core.numericAttributes(polygons, feats)
+    if args.local and len(feats) > 1:
+        sys.exit("The local Moran's I is computed for one attribute at a time")
+    if args.bivariate and len(feats) < 2:
+        sys.exit("The bivariate Moran's I needs at least two attributes")
+    if args.correlogram and (len(feats) > 1 or args.method == core.METHODS[0]):
+        sys.exit("The correlogram needs one attribute and a distance method")
+
+    store = None if args.no_cache else cache.WeightsCache(args.cache_dir)
+    params, table, Cs, Ws = core.run(polygons, feats, args.method, args.neighbors, args.contiguity, args.buffer,
+                                     args.radius, args.power, args.permutations, args.seed, args.workers, store, stages, args.engine, args.snap)
+    params['file'] = args.file
+    if args.export_weights:
+        core.exportWeights(args.export_weights, Cs, Ws, args.weights_format, polygons.index, os.path.basename(args.file))
+    if args.correlogram:
+        core.correlogram(polygons, feats[0], args.method, args.lags, args.lag_type, args.radius, args.power, args.permutations,
+                         args.seed, args.workers, stages= stages).to_csv(args.correlogram, index= False)
+    if args.bivariate:
+        core.bivariate(polygons, feats, Ws, args.permutations, args.seed, args.workers, stages= stages).to_csv(args.bivariate, index= False)
+    if args.local:
+        core.local(polygons, feats[0], Ws, args.permutations, args.seed, args.workers, args.alpha, stages= stages).to_csv(args.local)
+    stages.dump()
+
+    if args.output.lower().endswith('.csv'):
+        for key, value in params.items():
+            table[key] = value
+        table.to_csv(args.output, index= False)
+        pd.DataFrame(stages.table()).to_csv(f'{os.path.splitext(args.output)[0]}_stages.csv', index= False)
+        return
+
+    records = [{'feature': row['feature'], **params, **row, 'stages': stages.table()} for row in table.to_dict('records')]
+    results = records[0] if len(records) == 1 else records
+    if args.output == '-':
+        json.dump(results, sys.stdout, indent= 2)
+        sys.stdout.write('\n')
+    else:
+        with open(args.output, 'w') as file:
+            json.dump(results, file, indent= 2)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,245 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+#+----------+-----------------------------------------------------------------+
+#|   TITLE  | Moran's Index Calculator - Scaling Benchmark                    |
+#+----------+-----------------------------------------------------------------+
+#|  DETAILS |Times every pipeline stage (load, weights, statistic, inference) |
+#|          |on synthetic grid and Voronoi layers with known contiguity and a |
+#|          |known spatial autoregressive attribute. Wall time and peak       |
+#|          |memory of each stage are written as JSON, a previous results     |
+#|          |file can be compared against. The cold start import time of the |
+#|          |pipeline, the application and the command line is measured too. |
+#+----------+-----------------------------------------------------------------+
+#|  EXAMPLE |python benchmark.py -n 100 10000 -o new.json --compare old.json  |
+#+----------+-----------------------------------------------------------------+
+
+import argparse, json, os, platform, subprocess, sys, tempfile, time, tracemalloc
+import geopandas as gpd
+import numpy as np
+import shapely
+import core, moran, weights
+
+LAYERS = ['grid', 'voronoi']
+STAGES = ['Rook', 'Queen', 'Vertex Rook', 'Vertex Queen', 'Distance', 'Distance Band', 'Inverse Distance']
+FORMATS = {'parquet': '.parquet', 'gpkg': '.gpkg', 'fgb': '.fgb', 'shp': '.shp'}
+#Names the first user action calls must resolve right after the bare import,
+#a lazy import must not leave them missing (e.g. the Open file dialog)
+STARTUP = {'core': ['loadLayer', 'buildWeights'], 'MoransIcli': ['main'],
+           'MoransIapp': ['filedialog.askopenfilename', 'messagebox.showerror', 'messagebox.askyesno', 'messagebox.showinfo']}
+#Modules only the stages that need them should import
+HEAVY = ['geopandas', 'pyogrio', 'scipy.stats', 'scipy.spatial', 'matplotlib', 'pandastable', 'PIL', 'tkinter']
+
+
+
+#-----------------------------------------------------------------------------#
+#------------------------ S Y N T H E T I C   L A Y E R S --------------------#
+#-----------------------------------------------------------------------------#
+def gridLayer(n):
+    "Square lattice of about n unit cells with its exact contiguity link counts"
+    side = max(2, int(round(np.sqrt(n))))
+    x, y = np.meshgrid(np.arange(side), np.arange(side))
+    x, y = x.ravel(), y.ravel()
+    #Edge neighbors plus corner neighbors, the Rook (intersects) and Queen
+    #(touches) predicates both link the corners of a clean lattice, the vertex
+    #engine keeps corners for Queen only
+    edges = 4 * side * (side - 1)
+    links = edges + 4 * (side - 1)**2
+    return shapely.box(x, y, x + 1, y + 1), {'Rook': links, 'Queen': links, 'Vertex Rook': edges, 'Vertex Queen': links}
+
+def voronoiLayer(n, seed=0):
+    "Voronoi cells of n random points in a square of n unit areas"
+    size = np.sqrt(n)
+    points = np.random.default_rng(seed).random((n, 2)) * size
+    frame = shapely.box(0, 0, size, size)
+    cells = shapely.get_parts(shapely.voronoi_polygons(shapely.multipoints(points), extend_to= frame))
+    return shapely.intersection(cells, frame), {}
+
+def autoregressive(coords, rho, seed=0, k=4, steps=50):
+    "Attribute of a spatial autoregressive process x = rho W x + e over the k nearest neighbors"
+    n = len(coords)
+    idx = weights.knn(coords, k)[0]
+    Ws = weights.rowStandardize(weights.fromPairs(np.repeat(np.arange(n), idx.shape[1]), idx.ravel(), np.ones(idx.size), n))
+    e = np.random.default_rng(seed).standard_normal(n)
+    x = e.copy()
+    for step in range(steps):
+        x = e + rho * (Ws @ x)
+    return x
+
+def syntheticLayer(kind, n, rho=0.6, seed=0):
+    "Synthetic polygon layer with an autocorrelated (sar) and a random (rnd) attribute"
+    geoms, expected = gridLayer(n) if kind == 'grid' else voronoiLayer(n, seed)
+    points = shapely.centroid(geoms)
+    coords = np.column_stack([shapely.get_x(points), shapely.get_y(points)])
+    layer = gpd.GeoDataFrame({'id': np.arange(len(geoms)), 'sar': autoregressive(coords, rho, seed),
+                              'rnd': np.random.default_rng(seed + 1).standard_normal(len(geoms))}, geometry= geoms)
+    return layer, expected
+
+#-----------------------------------------------------------------------------#
+#------------------------------ M E A S U R E --------------------------------#
+#-----------------------------------------------------------------------------#
+def measure(stage, record, results):
+    "Run stage() recording its wall time and peak traced memory, returns its result"
+    tracemalloc.start()
+    start = time.perf_counter()
+    value = stage()
+    seconds = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    results.append({**record, 'seconds': seconds, 'peak_mb': peak / 2**20})
+    stage = f"{record.get('method', '')} {record['stage']}".strip()
+    print(f"{record['layer']:>8} {record['n']:>9} {stage:<28} {seconds:10.3f} s {peak / 2**20:10.1f} MB", file= sys.stderr)
+    return value
+
+def mismatch(row, message):
+    "Flag a failed check of a result row, the benchmark then exits non-zero"
+    row['mismatch'] = message
+    print(f"{row['layer']:>8} {row['n']:>9} {row.get('method', '')} {row['stage']} MISMATCH: {message}", file= sys.stderr)
+
+def benchmarkLayer(kind, n, args, folder, results):
+    layer, expected = syntheticLayer(kind, n, args.rho, args.seed)
+    filename = os.path.join(folder, f'{kind}{n}{FORMATS[args.format]}')
+    if args.format == 'parquet':
+        layer.to_parquet(filename)
+    else:
+        layer.to_file(filename)
+    base = {'layer': kind, 'n': len(layer)}
+
+    polygons = measure(lambda: core.loadLayer(filename, ['sar', 'rnd']), {**base, 'stage': 'load'}, results)
+    dev = moran.deviations(polygons['sar'])
+    for method in args.methods:
+        if method in core.NEIGHBOR_METHODS:
+            build = lambda: core.buildWeights(polygons, core.METHODS[0], args.k, method)
+        elif method.startswith('Vertex'):
+            build = lambda: core.buildWeights(polygons, core.METHODS[0], args.k, method.split()[1], engine= core.ENGINES[1])
+        elif method == 'Distance Band':
+            #The band is scaled by the median nearest neighbor distance of the
+            #layer, on the Voronoi layer it leaves features without neighbors
+            #(S0 < n), on the grid it links the edge neighbors
+            radius = args.band * np.median(weights.knn(core.centroids(polygons), 1)[1])
+            build = lambda: core.buildWeights(polygons, core.METHODS[1], args.k, radius= radius)
+        else:
+            build = lambda: core.buildWeights(polygons, method, args.k, power= 1)
+        record = {**base, 'method': method}
+        Cs, Ws = measure(build, {**record, 'stage': 'weights'}, results)
+        results[-1]['nnz'] = int(Cs.nnz)
+        if method == 'Distance Band':
+            results[-1]['radius'] = float(radius)
+        if method in expected:
+            results[-1]['expected_nnz'] = expected[method]
+            if Cs.nnz != expected[method]:
+                mismatch(results[-1], f'{Cs.nnz} links, {expected[method]} expected')
+        if not Cs.nnz:
+            mismatch(results[-1], 'no links, the statistic stages are skipped')
+            continue
+
+        I = measure(lambda: moran.moransI(dev, Ws), {**record, 'stage': 'statistic'}, results)
+        results[-1]['I'] = float(I)
+        summary = measure(lambda: moran.analytical(dev, Ws, I), {**record, 'stage': 'analytical'}, results)
+        if args.permutations:
+            reps = measure(lambda: moran.permutations(dev, Ws, args.permutations, args.seed, args.workers),
+                           {**record, 'stage': 'permutations', 'permutations': args.permutations}, results)
+            #The randomization variance is the exact variance of the permuted I,
+            #they may only differ by the sampling error of the permutations
+            ratio = np.std(reps) / np.sqrt(summary['VI_rand'])
+            results[-1]['std_ratio'] = float(ratio)
+            if abs(ratio - 1) > 5 / np.sqrt(2 * args.permutations):
+                mismatch(results[-1], f'permutation std {ratio:.3f} x the randomization std')
+    os.remove(filename)
+
+def startup(repeat):
+    "Best import time of every STARTUP module in a fresh interpreter, with the HEAVY modules it pulls in"
+    code = ("import operator, sys, time; start = time.perf_counter(); import {0}; seconds = time.perf_counter() - start; "
+            "[operator.attrgetter(name)({0}) for name in {1!r}]; "
+            f"print(seconds, *[name for name in {HEAVY!r} if name in sys.modules])")
+    results = []
+    for module, names in STARTUP.items():
+        runs = []
+        for run in range(repeat):
+            run = subprocess.run([sys.executable, '-c', code.format(module, names)], capture_output= True, text= True,
+                                 cwd= os.path.dirname(os.path.abspath(__file__)))
+            if run.returncode:
+                sys.exit(f'startup check of {module} failed:\n{run.stderr}')
+            runs.append(run.stdout.split())
+        results.append({'module': module, 'seconds': min(float(run[0]) for run in runs), 'heavy': runs[0][1:]})
+        print(f"{'startup':>8} {module:>9} {'import':<28} {results[-1]['seconds']:10.3f} s   {' '.join(runs[0][1:])}", file= sys.stderr)
+    return results
+
+#-----------------------------------------------------------------------------#
+#------------------------------ C O M P A R E --------------------------------#
+#-----------------------------------------------------------------------------#
+def key(row):
+    return (row['layer'], row['n'], row.get('method', ''), row['stage'])
+
+def compare(old, new):
+    "Time and memory ratios new / old of the stages present in both result sets"
+    before = {key(row): row for row in old['results']}
+    print(f"{'layer':>8} {'n':>9} {'stage':<28} {'time':>8} {'memory':>8}")
+    for row in new['results']:
+        if key(row) in before:
+            prev = before[key(row)]
+            stage = f"{row.get('method', '')} {row['stage']}".strip()
+            speed = row['seconds'] / max(prev['seconds'], 1e-9)
+            memory = row['peak_mb'] / max(prev['peak_mb'], 1e-9)
+            print(f"{row['layer']:>8} {row['n']:>9} {stage:<28} {speed:7.2f}x {memory:7.2f}x")
+    before = {row['module']: row for row in old.get('startup', [])}
+    for row in new.get('startup', []):
+        if row['module'] in before:
+            speed = row['seconds'] / max(before[row['module']]['seconds'], 1e-9)
+            print(f"{'startup':>8} {row['module']:>9} {'import':<28} {speed:7.2f}x")
+
+def version():
+    "Git revision of the calculator, None outside a repository"
+    try:
+        return subprocess.run(['git', 'describe', '--always', '--dirty'], capture_output= True, text= True,
+                              cwd= os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+#-----------------------------------------------------------------------------#
+#--------------------------------- M A I N -----------------------------------#
+#-----------------------------------------------------------------------------#
+def parser():
+    p = argparse.ArgumentParser(description= "Scaling benchmark of the Moran's I pipeline on synthetic layers")
+    p.add_argument('-n', '--sizes', type= int, nargs= '+', default= [10**2, 10**3, 10**4, 10**5, 10**6], help= 'number of features of the layers')
+    p.add_argument('-l', '--layers', choices= LAYERS, nargs= '+', default= LAYERS)
+    p.add_argument('-m', '--methods', choices= STAGES, nargs= '+', default= STAGES, help= 'weight methods to build')
+    p.add_argument('-k', '--neighbors', dest= 'k', type= int, default= 8)
+    p.add_argument('-b', '--band', type= float, default= 1.2, help= 'radius of the Distance Band weights, in median nearest neighbor distances')
+    p.add_argument('-p', '--permutations', type= int, default= 99, help= '0 skips the permutation stage')
+    p.add_argument('-r', '--rho', type= float, default= 0.6, help= 'autoregressive parameter of the sar attribute')
+    p.add_argument('-s', '--seed', type= int, default= 0)
+    p.add_argument('-w', '--workers', type= int, default= os.cpu_count() or 1)
+    p.add_argument('-f', '--format', choices= FORMATS, default= 'parquet', help= 'file format of the load stage')
+    p.add_argument('--startup', type= int, default= 3, metavar= 'REPEAT', help= 'cold start imports to time, 0 skips them')
+    p.add_argument('-o', '--output', default= '-', help= 'results JSON file (default: stdout)')
+    p.add_argument('--compare', default= None, metavar= 'JSON', help= 'earlier results to print time and memory ratios against')
+    return p
+
+def main(argv=None):
+    args = parser().parse_args(argv)
+    results = []
+    imports = startup(args.startup) if args.startup else []
+    with tempfile.TemporaryDirectory() as folder:
+        for n in args.sizes:
+            for kind in args.layers:
+                benchmarkLayer(kind, n, args, folder, results)
+
+    report = {'version': version(), 'python': platform.python_version(), 'numpy': np.__version__,
+              'machine': platform.machine(), 'cpus': os.cpu_count(), 'workers': args.workers,
+              'startup': imports, 'results': results}
+    if args.output == '-':
+        json.dump(report, sys.stdout, indent= 2)
+        sys.stdout.write('\n')
+    else:
+        with open(args.output, 'w') as file:
+            json.dump(report, file, indent= 2)
+    if args.compare:
+        with open(args.compare) as file:
+            compare(json.load(file), report)
+    failed = [row for row in results if 'mismatch' in row]
+    if failed:
+        sys.exit(f'{len(failed)} result check(s) failed')
+
+if __name__ == '__main__':
+    main()
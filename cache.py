@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+#+----------+-----------------------------------------------------------------+
+#|   TITLE  | Weights Cache                                                   |
+#+----------+-----------------------------------------------------------------+
+#|  DETAILS |Persistent on-disk cache of built weight tables. Entries are     |
+#|          |keyed by a hash of the layer geometry plus the method and its    |
+#|          |parameters, stored as memory mapped folders that several         |
+#|          |processes open read only and zero-copy, and evicted least        |
+#|          |recently used once the cache exceeds its size limit.             |
+#+----------+-----------------------------------------------------------------+
+
+import hashlib, json, os, re, shutil, tempfile
+import numpy as np
+import shapely
+import weights
+
+CACHE_DIR = os.environ.get('MORANSI_CACHE', os.path.join(os.path.expanduser('~'), '.cache', 'moransi'))
+CACHE_BYTES = int(os.environ.get('MORANSI_CACHE_BYTES', 2**30))
+#Only entries named by a key and holding the mapped arrays are ever removed,
+#the folder may hold other files (older npz entries are cache files too)
+KEY = re.compile('[0-9a-f]{64}')
+ENTRY_FILES = {'indptr.npy', 'indices.npy', 'data.npy', 'wdata.npy'}
+
+
+
+def geometryHash(geoms):
+    "Content hash of the layer geometry, independent of the file it came from"
+    digest = hashlib.sha256()
+    digest.update(str(len(geoms)).encode())
+    for wkb in shapely.to_wkb(np.asarray(geoms)):
+        digest.update(wkb)
+    return digest.hexdigest()
+
+class WeightsCache(object):
+    def __init__(self, folder=CACHE_DIR, maxBytes=CACHE_BYTES):
+        self.folder = folder
+        self.maxBytes = maxBytes
+
+    def key(self, layer, method, **params):
+        "Cache key of a layer hash, a method and its parameters"
+        text = json.dumps([layer, method, params], sort_keys=True, default=str)
+        return hashlib.sha256(text.encode()).hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.folder, key)
+
+    def get(self, key):
+        "Cached weight tables (Cs, Ws) of key, memory mapped, None when missing or unreadable"
+        path = self.path(key)
+        try:
+            tables = weights.loadMapped(path)
+        except (OSError, ValueError):
+            return None
+        #Reading marks the entry as recently used, a cache shared read only
+        #by another user is read without the mark
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        return tables
+
+    def put(self, key, C):
+        "Store a weight table and evict the least recently used entries"
+        #The entry is written aside and renamed into place, a reader never
+        #sees it half written and the first of two concurrent writers wins
+        try:
+            os.makedirs(self.folder, exist_ok=True)
+            tmp = tempfile.mkdtemp(prefix='.', dir=self.folder)
+        except OSError:
+            #A read only cache serves hits, the tables of a miss are not kept
+            return
+        try:
+            weights.saveMapped(tmp, C)
+            #mkdtemp is private, entries are shared with other users of the folder
+            os.chmod(tmp, 0o755)
+            os.rename(tmp, self.path(key))
+        except OSError:
+            pass
+        finally:
+            shutil.rmtree(tmp, ignore_errors=True)
+        self.evict()
+
+    def size(self, path):
+        if os.path.isdir(path):
+            return sum(entry.stat().st_size for entry in os.scandir(path))
+        return os.stat(path).st_size
+
+    def entries(self):
+        "Paths of the cache entries in the folder, anything else is left alone"
+        paths = []
+        for name in os.listdir(self.folder):
+            path = os.path.join(self.folder, name)
+            if KEY.fullmatch(name) and os.path.isdir(path) and set(os.listdir(path)) == ENTRY_FILES:
+                paths.append(path)
+            elif name.endswith('.npz') and KEY.fullmatch(name[:-4]) and os.path.isfile(path):
+                paths.append(path)
+        return paths
+
+    def evict(self):
+        #Entries still mapped by another process stay readable after removal
+        #on POSIX, where removal fails (Windows) they are kept for later
+        entries = []
+        for path in self.entries():
+            try:
+                entries.append((os.stat(path).st_mtime, self.size(path), path))
+            except OSError:
+                pass
+        entries.sort()
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if total <= self.maxBytes:
+                break
+            try:
+                self.remove(path)
+                total -= size
+            except OSError:
+                pass
+
+    def remove(self, path):
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        else:
+            os.remove(path)
+
+    def clear(self):
+        if os.path.isdir(self.folder):
+            for path in self.entries():
+                self.remove(path)
@@ -0,0 +1,281 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+#+----------+-----------------------------------------------------------------+
+#|   TITLE  | Moran's I Core                                                  |
+#+----------+-----------------------------------------------------------------+
+#|  DETAILS |GUI-free pipeline of the Moran's I calculator: load a layer,     |
+#|          |build the spatial weights, compute Moran's I and its inference.  |
+#|          |Used by the Tk application and the command line batch runner.    |
+#+----------+-----------------------------------------------------------------+
+
+import importlib.util, json
+import numpy as np
+import pandas as pd
+import cache, instrument, moran, weights
+
+METHODS = ['Neighbors', 'Distance', 'Inverse Distance']
+NEIGHBOR_METHODS = ['Rook', 'Queen']
+#Contiguity from STRtree predicates (Rook: intersects, Queen: touches) or from
+#shared vertices / edges of a clean coverage (Rook: shared edge, Queen: shared
+#vertex), the vertex engine falls back to predicates where it is not clean.
+#The engines define Rook differently, so switching changes the weights
+ENGINES = ['predicate', 'vertex']
+ENGINE_LABELS = ['Predicates (Rook: any shared point)', 'Shared vertices (Rook: shared edge)']
+LAYER_TYPES = [("Vector layers", "*.shp *.gpkg *.fgb *.parquet *.geoparquet"), ("ESRI shape files", "*.shp"),
+               ("GeoPackage", "*.gpkg"), ("FlatGeobuf", "*.fgb"), ("GeoParquet", "*.parquet *.geoparquet")]
+
+#geopandas, pyogrio and pyarrow are imported by the loaders that need them,
+#so batch jobs importing the pipeline start quickly. Arrow batches
+#are much faster than row by row reading when pyarrow exists
+ARROW = importlib.util.find_spec('pyarrow') is not None
+
+
+
+#-----------------------------------------------------------------------------#
+#----------------------------- L O A D   L A Y E R ---------------------------#
+#-----------------------------------------------------------------------------#
+def isParquet(filename):
+    return filename.lower().endswith(('.parquet', '.geoparquet'))
+
+def parquetSchema(filename):
+    "Field names and geometry column of a GeoParquet file"
+    import pyarrow.parquet as pq
+    schema = pq.read_schema(filename)
+    geometry = json.loads(schema.metadata[b'geo'])['primary_column']
+    return [name for name in schema.names if name != geometry], geometry
+
+def layerFields(filename):
+    "Attribute fields of a layer, read from its schema without loading any data"
+    if isParquet(filename):
+        return parquetSchema(filename)[0]
+    import pyogrio
+    return list(pyogrio.read_info(filename)['fields'])
+
+def layerAttributes(filename):
+    "Candidate attributes of a layer file, every field after the first one"
+    return layerFields(filename)[1:]
+
+def loadLayer(filename, columns=None, centroids=False):
+    "Layer with only the given columns (None: all) and its geometry, or the centroids of it"
+    import geopandas as gpd
+    if isParquet(filename):
+        geometry = parquetSchema(filename)[1]
+        layer = gpd.read_parquet(filename, columns= None if columns is None else list(columns) + [geometry])
+    else:
+        layer = gpd.read_file(filename, columns= columns, use_arrow= ARROW)
+    if centroids:
+        layer[layer.geometry.name] = layer.centroid
+    return layer
+
+def loadColumns(filename, columns=None):
+    "Attribute table of a layer file without reading its geometry"
+    if isParquet(filename):
+        return pd.read_parquet(filename, columns= layerFields(filename) if columns is None else list(columns))
+    import geopandas as gpd
+    return gpd.read_file(filename, columns= columns, read_geometry= False, use_arrow= ARROW)
+
+def attributes(polygons):
+    "Candidate attributes, the columns after the first one except the geometry"
+    return [name for name in polygons.columns[1:] if name != polygons.geometry.name]
+
+def numericAttributes(table, feats=None):
+    "Attributes among feats (default: the candidate attributes) holding numbers"
+    feats = attributes(table) if feats is None else list(feats)
+    return list(table[feats].select_dtypes('number').columns)
+
+def centroids(polygons):
+    "Centroid coordinates of the polygons as an n x 2 array"
+    points = polygons.centroid
+    return np.column_stack([points.x, points.y])
+
+#-----------------------------------------------------------------------------#
+#--------------------------- B U I L D   W E I G H T S -----------------------#
+#-----------------------------------------------------------------------------#
+def weightParams(method, neighN, neighbormethod='Rook', buffer=0, radius=np.inf, power=0, engine=ENGINES[0], snap=0):
+    "Parameters that define the weight table of a method"
+    if method == METHODS[0]:
+        #Contiguity is kept unrestricted, neighN is cut after the lookup
+        return {'neighbormethod': neighbormethod, 'buffer': float(buffer), 'engine': engine, 'snap': float(snap)}
+    params = {'neighN': int(neighN or 0), 'radius': float(radius)}
+    if method == METHODS[2]:
+        params['power'] = float(power)
+    return params
+
+def firstNeighbors(tables, neighN):
+    "Contiguity tables (Cs, Ws) cut to the first neighN neighbors of every feature"
+    #Tables no row of which has more neighbors are returned as they are, so
+    #mapped cache entries stay zero-copy
+    Cs, Ws = tables
+    if neighN is None or np.diff(Cs.indptr).max(initial=0) <= neighN:
+        return Cs, Ws
+    Cs = weights.firstK(Cs, neighN)
+    return Cs, weights.rowStandardize(Cs)
+
+def buildWeights(polygons, method, neighN, neighbormethod='Rook', buffer=0, radius=np.inf, power=0, coords=None, tree=None, store=None, layer=None, progress=None, candidates=None, engine=ENGINES[0], snap=0):
+    "Weight table Cs and its row standardized table Ws for the chosen method"
+    #weights.Candidates kept from an earlier run only cut their sorted links,
+    #which is cheaper than a cache lookup
+    if candidates is not None and method in METHODS[1:]:
+        rows, cols, dists = candidates.links(radius, neighN or None)
+        Cs = weights.fromDistances(rows, cols, dists, len(candidates.coords), power if method == METHODS[2] else 0)
+        return Cs, weights.rowStandardize(Cs)
+    
+    #A WeightsCache store skips construction when the layer was seen before
+    if store is not None:
+        layer = cache.geometryHash(polygons.geometry.values) if layer is None else layer
+        key = store.key(layer, method, **weightParams(method, neighN, neighbormethod, buffer, radius, power, engine, snap))
+        contiguity = method == METHODS[0]
+        tables = store.get(key)
+        if tables is None:
+            Cs = buildWeights(polygons, method, None if contiguity else neighN, neighbormethod, buffer, radius, power, coords, tree, progress= progress, engine= engine, snap= snap)[0]
+            store.put(key, Cs)
+            #The stored tables are mapped back, so the in-memory copy is freed
+            tables = store.get(key) or (Cs, weights.rowStandardize(Cs))
+        return firstNeighbors(tables, neighN) if contiguity else tables
+    
+    if method == METHODS[0]:
+        #A buffer grows the polygons, which only the predicates can do, the
+        #vertex engine snaps its vertices to a grid of size snap instead
+        if engine == ENGINES[1] and buffer > 0:
+            instrument.log.info('A contiguity buffer needs the predicates, the vertex engine is not used')
+        if engine == ENGINES[1] and not buffer > 0:
+            Cs = weights.vertexContiguity(polygons.geometry.values, neighbormethod, snap, progress)
+        else:
+            Cs = weights.contiguity(polygons.geometry.values, neighbormethod, buffer, progress)
+        if neighN is not None:
+            Cs = weights.firstK(Cs, neighN)
+    elif method in METHODS[1:]:
+        coords = centroids(polygons) if coords is None else coords
+        power = power if method == METHODS[2] else 0
+        rows, cols, dists = weights.distanceBand(coords, radius, neighN or None, tree)
+        Cs = weights.fromDistances(rows, cols, dists, len(coords), power)
+    else:
+        raise ValueError(f"Unknown method: {method}")
+    return Cs, weights.rowStandardize(Cs)
+
+def exportWeights(base, Cs, Ws, fmt='csv', ids=None, layer='layer'):
+    "Write the weight table (W) and the row standardized table (NW), returns the paths"
+    #GAL only lists neighbors, so the weights go along as GWT
+    files = {'gal': [(Cs, '.gal'), (Cs, '.gwt'), (Ws, 'NW.gwt')]}.get(fmt, [(Cs, f'W.{fmt}'), (Ws, f'NW.{fmt}')])
+    paths = []
+    for C, suffix in files:
+        weights.writeWeights(C, f'{base}{suffix}', suffix.rsplit('.', 1)[1], ids, layer)
+        paths.append(f'{base}{suffix}')
+    return paths
+
+#-----------------------------------------------------------------------------#
+#------------------------------ M O R A N S   I ------------------------------#
+#-----------------------------------------------------------------------------#
+def permutationInference(dev, Ws, I, nperm=999, seed=None, workers=1, progress=None):
+    "Summary of the permutation test of I and the permuted Moran's I values"
+    reps = moran.permutations(dev, Ws, nperm, seed, workers, progress)
+    EI = -1 / (len(dev) - 1)
+    std = np.std(reps, axis=0)
+    summary = {'EI': EI, 'mean': np.mean(reps, axis=0), 'std': std,
+               'z': (I - EI) / std, 'p': moran.pseudoPvalue(I, reps)}
+    return summary, reps
+
+def screen(polygons, feats, Ws, nperm=999, seed=None, workers=1, progress=None, stages=None):
+    "Moran's I of every attribute in feats over one weight table, one row each"
+    #The analytical inference is always there, permutations only when nperm > 0
+    with instrument.stage(stages, 'statistic') as record:
+        dev = moran.deviations(polygons[list(feats)].to_numpy(dtype=float))
+        I = moran.moransI(dev, Ws)
+        record.update(n= len(dev), attributes= len(feats))
+    with instrument.stage(stages, 'analytical'):
+        table = pd.DataFrame({'feature': list(feats), 'I': I, **moran.analytical(dev, Ws, I)})
+    if nperm:
+        with instrument.stage(stages, 'permutations') as record:
+            summary = permutationInference(dev, Ws, I, nperm, seed, workers, progress)[0]
+            record.update(permutations= nperm, attributes= len(feats), workers= workers)
+        for key, value in summary.items():
+            table[key] = value
+    return table
+
+def bivariate(polygons, feats, Ws, nperm=999, seed=None, workers=1, progress=None, stages=None):
+    "Bivariate Moran's I of every pair of attributes, x against the spatial lag of y, one row per pair"
+    with instrument.stage(stages, 'bivariate') as record:
+        record.update(attributes= len(feats), permutations= nperm)
+        feats = list(feats)
+        dev = moran.deviations(polygons[feats].to_numpy(dtype=float))
+        I = moran.bivariate(dev, Ws)
+        x, y = np.meshgrid(range(len(feats)), range(len(feats)), indexing= 'ij')
+        table = pd.DataFrame({'x': np.array(feats)[x.ravel()], 'y': np.array(feats)[y.ravel()], 'I': I.ravel()})
+        if nperm:
+            mean, std, p = moran.bivariatePermutations(dev, Ws, I, nperm, seed, workers, progress)
+            table['mean'] = mean.ravel()
+            table['std'] = std.ravel()
+            table['z'] = (table['I'] - table['mean']) / table['std']
+            table['p'] = p.ravel()
+        return table
+
+def local(polygons, feat, Ws, nperm=999, seed=None, workers=1, alpha=0.05, progress=None, stages=None):
+    "Local Moran's I (LISA) table, one row per feature with its cluster label"
+    with instrument.stage(stages, 'local') as record:
+        record.update(n= len(polygons), permutations= nperm)
+        dev = moran.deviations(polygons[feat])
+        Ii, lag, quadrant = moran.localMoran(dev, Ws)
+        table = pd.DataFrame({'I': Ii, 'z': dev / np.std(dev), 'lag': lag, 'quadrant': moran.QUADRANTS[quadrant]}, index= polygons.index)
+        if nperm:
+            table['p'] = moran.localPermutations(dev, Ws, nperm, seed, workers, progress)
+            table['cluster'] = table['quadrant'].where(table['p'] <= alpha, 'Not significant')
+        return table
+
+def correlogram(polygons, feat, method, lags, by='k', radius=np.inf, power=0, nperm=999, seed=None, workers=1, progress=None, candidates=None, stages=None):
+    "Moran's I of feat at every lag, k nearest neighbors or distance bands, one row per lag"
+    with instrument.stage(stages, 'correlogram') as record:
+        record.update(lags= len(lags), permutations= nperm)
+        #One candidate query up to the largest lag is cut for every lag. Bands are
+        #the rings between consecutive edges, k lags are cumulative (cut at radius)
+        if method not in METHODS[1:]:
+            raise ValueError(f"A correlogram needs a distance method, not {method}")
+        lags = np.unique(np.asarray(lags, dtype=float))
+        power = power if method == METHODS[2] else 0
+        candidates = weights.Candidates(centroids(polygons)) if candidates is None else candidates
+        n = len(candidates.coords)
+    
+        tables, lower = [], np.concatenate([[0], lags[:-1]])
+        if by == 'k':
+            lags = lags.astype(int)
+            candidates.links(radius, int(lags[-1]))
+            for k in lags:
+                tables.append(weights.fromDistances(*candidates.links(radius, int(k)), n, power))
+        elif by == 'band':
+            rows, cols, dists = candidates.links(lags[-1])
+            for low, high in zip(lower, lags):
+                ring = (dists > low) & (dists <= high)
+                tables.append(weights.fromDistances(rows[ring], cols[ring], dists[ring], n, power))
+        else:
+            raise ValueError(f"Unknown correlogram lags: {by}")
+        tables = [weights.rowStandardize(Cs) for Cs in tables]
+    
+        dev = moran.deviations(polygons[feat])
+        I = np.array([moran.moransI(dev, Ws) for Ws in tables])
+        table = pd.DataFrame([{'lag': lag, 'nnz': Ws.nnz, 'I': i, **moran.analytical(dev, Ws, i)} for lag, Ws, i in zip(lags, tables, I)])
+        if by == 'band':
+            table.insert(0, 'from', lower)
+        if nperm:
+            reps = moran.lagPermutations(dev, tables, nperm, seed, workers, progress)
+            EI = table['EI']
+            table['mean'] = np.mean(reps, axis=0)
+            table['std'] = np.std(reps, axis=0)
+            table['z'] = (I - EI) / table['std']
+            table['p'] = moran.pseudoPvalue(I, reps)
+        return table
+
+def run(polygons, feats, method, neighN, neighbormethod='Rook', buffer=0, radius=np.inf, power=0, nperm=999, seed=None, workers=1, store=None, stages=None, engine=ENGINES[0], snap=0):
+    "Full analysis of the attribute(s) feats: parameters, one results row per attribute and the weight tables"
+    with instrument.stage(stages, 'weights') as record:
+        Cs, Ws = buildWeights(polygons, method, neighN, neighbormethod, buffer, radius, power, store= store, engine= engine, snap= snap)
+        record.update(n= len(polygons), nnz= int(Cs.nnz))
+    feats = [feats] if isinstance(feats, str) else list(feats)
+
+    params = {'method': method, 'n': len(polygons), 'nnz': int(Cs.nnz), 'neighbors': neighN}
+    if method == METHODS[0]:
+        params.update({'contiguity': neighbormethod, 'buffer': buffer, 'engine': engine, 'snap': snap})
+    else:
+        params.update({'radius': None if np.isinf(radius) else radius, 'power': power if method == METHODS[2] else 0})
+    if nperm:
+        params.update({'permutations': nperm, 'seed': seed})
+    return params, screen(polygons, feats, Ws, nperm, seed, workers, stages= stages), Cs, Ws
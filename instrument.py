@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+#+----------+-----------------------------------------------------------------+
+#|   TITLE  | Stage Instrumentation                                           |
+#+----------+-----------------------------------------------------------------+
+#|  DETAILS |Wall time, CPU time and peak memory of every pipeline stage of a |
+#|          |run, with counts such as n, nnz and permutations. Stages are     |
+#|          |logged to the 'moransi' logger and can be profiled with cProfile.|
+#+----------+-----------------------------------------------------------------+
+
+import cProfile, logging, os, sys, time, tracemalloc
+from contextlib import contextmanager, nullcontext
+try:
+    import resource
+except ImportError:
+    resource = None
+
+PROFILE = os.environ.get('MORANSI_PROFILE')
+log = logging.getLogger('moransi')
+
+
+
+def maxRSS():
+    "Peak resident memory of the process in MB, None where it is not available"
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    #Linux reports kilobytes, macOS bytes
+    return rss / (2**20 if sys.platform == 'darwin' else 2**10)
+
+def stage(stages, name):
+    "Stage of stages, or nothing when the run is not instrumented"
+    return nullcontext({}) if stages is None else stages.stage(name)
+
+class Stages(object):
+    "Records of the stages of one run, a repeated stage replaces its last record"
+    #Traced memory slows every allocation, so it is opt-in and only traced
+    #while a stage runs, otherwise the process peak RSS is recorded
+    def __init__(self, memory=False, profile=PROFILE):
+        self.memory = memory
+        self.profile = profile
+        self.profiler = cProfile.Profile() if profile else None
+        self.records = {}
+        self.depth = 0
+        self.tracing = False
+
+    @contextmanager
+    def stage(self, name):
+        "Measure the block as stage name, counts can be added to the yielded record"
+        #Traced memory covers numpy and Python allocations of every thread,
+        #the process peak RSS also covers GEOS and other native libraries
+        record = {'stage': name}
+        if self.memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self.tracing = True
+        if self.memory:
+            tracemalloc.reset_peak()
+            base = tracemalloc.get_traced_memory()[0]
+        if self.profiler is not None:
+            self.profiler.enable()
+        self.depth += 1
+        wall, cpu = time.perf_counter(), time.process_time()
+        try:
+            yield record
+        finally:
+            record['wall'] = time.perf_counter() - wall
+            record['cpu'] = time.process_time() - cpu
+            self.depth -= 1
+            if self.profiler is not None:
+                self.profiler.disable()
+            if self.memory:
+                record['peak_mb'] = (tracemalloc.get_traced_memory()[1] - base) / 2**20
+            #Tracing started here stops with the outermost stage
+            if self.tracing and not self.depth:
+                tracemalloc.stop()
+                self.tracing = False
+            record['rss_mb'] = maxRSS()
+            self.records.pop(name, None)
+            self.records[name] = record
+            log.info(self.line(record))
+
+    def line(self, record):
+        "One line summary of a stage record"
+        text = f"{record['stage']}: {record['wall']:.3f} s wall, {record['cpu']:.3f} s cpu"
+        if 'peak_mb' in record:
+            text += f", {record['peak_mb']:.1f} MB peak"
+        elif record.get('rss_mb') is not None:
+            text += f", {record['rss_mb']:.0f} MB max RSS"
+        counts = [f'{key} {value}' for key, value in record.items() if key not in ('stage', 'wall', 'cpu', 'peak_mb', 'rss_mb')]
+        return text + (f" ({', '.join(counts)})" if counts else '')
+
+    def text(self):
+        "Stage summary, one line each"
+        return ''.join(f'   {self.line(record)}\n' for record in self.records.values())
+
+    def table(self):
+        "Stage records as a list of dicts"
+        return list(self.records.values())
+
+    def dump(self, filename=None):
+        "Write the cProfile statistics of every stage so far, for pstats or snakeviz"
+        filename = self.profile if filename is None else filename
+        if self.profiler is not None and filename:
+            self.profiler.dump_stats(filename)
+            log.info(f'profile written to {filename}')
@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import numpy as np
+import shapely
+from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg, NavigationToolbar2Tk
+from matplotlib.collections import PathCollection
+from matplotlib.figure import Figure
+from matplotlib.path import Path
+
+def polygonPaths(geoms):
+    "One matplotlib path per polygon part, holes included"
+    parts = shapely.get_parts(np.asarray(geoms))
+    parts = parts[shapely.get_type_id(parts) == 3]
+    parts = parts[~shapely.is_empty(parts)]
+    if not len(parts):
+        return []
+    coords, (rings, polygons) = shapely.to_ragged_array(parts, include_z=False)[1:]
+    
+    #Every ring starts with MOVETO and ends with CLOSEPOLY
+    codes = np.full(len(coords), Path.LINETO, dtype=Path.code_type)
+    codes[rings[:-1]] = Path.MOVETO
+    codes[rings[1:] - 1] = Path.CLOSEPOLY
+    bounds = rings[polygons]
+    return [Path(coords[start:end], codes[start:end]) for start, end in zip(bounds[:-1], bounds[1:])]
+
+class MapView(object):
+    "One persistent map canvas, polygons are drawn with the detail the zoom needs"
+    def __init__(self, master, bg='#565051', face='#98AFC7', pixels=500):
+        self.figure = Figure(figsize=(5,4), dpi=100, facecolor=face)
+        self.ax = self.figure.add_axes([0, 0, 1, 1])
+        self.ax.set_aspect('equal')
+        self.ax.axis('off')
+        self.ax.fmt_xdata = lambda x: "{:.3f}".format(x)
+        self.ax.fmt_ydata = lambda x: "{:.3f}".format(x)
+        self.canvas = FigureCanvasTkAgg(self.figure, master=master)
+        self.toolbar = NavigationToolbar2Tk(self.canvas, master)
+        for button in self.toolbar.winfo_children():
+            button.config(background=bg)
+        self.toolbar.config(background=bg)
+        self.toolbar._message_label.place(relx=0.04, rely=0.02)
+        self.pixels = pixels
+        self.geoms = None
+        self.levels = {}
+        self.level = None
+        self.polygons = None
+        self.centroids = None
+        self.ax.callbacks.connect('xlim_changed', lambda ax: self.refine())
+
+    def setLayer(self, geoms):
+        "Draw a new polygon layer, the paths of every detail level are cached"
+        self.geoms = np.asarray(geoms)
+        self.levels = {}
+        self.level = None
+        if self.polygons is not None:
+            self.polygons.remove()
+        if self.centroids is not None:
+            self.centroids.remove()
+            self.centroids = None
+        self.polygons = PathCollection([], facecolor='#FFE4B5', edgecolor='k', linewidth=0.5)
+        self.ax.add_collection(self.polygons)
+        xmin, ymin, xmax, ymax = shapely.total_bounds(self.geoms)
+        self.ax.set_xlim(xmin, xmax)
+        self.ax.set_ylim(ymin, ymax)
+        self.refine()
+        self.canvas.draw_idle()
+
+    def setCentroids(self, coords):
+        "Overlay the centroids on the cached polygons"
+        if self.centroids is not None:
+            self.centroids.remove()
+        self.centroids = self.ax.scatter(coords[:, 0], coords[:, 1], color='green', s=10, zorder=2)
+        self.canvas.draw_idle()
+
+    def refine(self):
+        #Simplify to about a pixel of the current view, in powers of two
+        if self.geoms is None or not len(self.geoms):
+            return
+        xmin, xmax = self.ax.get_xlim()
+        pixels = self.canvas.get_tk_widget().winfo_width()
+        pixel = abs(xmax - xmin) / (pixels if pixels > 1 else self.pixels)
+        level = int(np.floor(np.log2(pixel))) if pixel > 0 else None
+        if level == self.level:
+            return
+        if level not in self.levels:
+            tolerance = 2.0**level if level is not None else 0
+            self.levels[level] = polygonPaths(shapely.simplify(self.geoms, tolerance, preserve_topology=True))
+        self.level = level
+        self.polygons.set_paths(self.levels[level])
+        self.canvas.draw_idle()
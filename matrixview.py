@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import tkinter as tk
+from tkinter import ttk
+import numpy as np
+import weights
+
+class NeighborView(tk.Frame):
+    "Paged view of sparse weight tables, only the visible rows are formatted"
+    def __init__(self, master, Cs, Ws, dev=None, ids=None, rows=50, bg='#565051'):
+        tk.Frame.__init__(self, master, bg=bg)
+        self.Cs = Cs
+        self.Ws = Ws
+        self.dev = dev
+        self.n = Cs.shape[0]
+        self.ids = np.arange(self.n) if ids is None else np.asarray(ids)
+        self.rows = rows
+        self.start = 0
+
+        columns = ['Feature', 'Neighbors', 'Neighbor ids', 'Weights', 'Normalized weights']
+        if dev is not None:
+            columns.append('Deviation')
+        self.table = ttk.Treeview(self, columns=columns, show='headings')
+        for column, width in zip(columns, [70, 70, 200, 200, 200, 80]):
+            self.table.heading(column, text=column)
+            self.table.column(column, width=width, stretch=column.endswith(('ids', 'eights')))
+        self.scrolly = tk.Scrollbar(self, orient='vertical', command=self.table.yview)
+        self.scrollx = tk.Scrollbar(self, orient='horizontal', command=self.table.xview)
+        self.table.configure(yscrollcommand=self.scrolly.set, xscrollcommand=self.scrollx.set)
+
+        self.bar = tk.Frame(self, bg=bg)
+        self.previous = tk.Button(self.bar, text='<', width=3, command=lambda: self.show(self.start - self.rows))
+        self.next = tk.Button(self.bar, text='>', width=3, command=lambda: self.show(self.start + self.rows))
+        self.page = tk.StringVar()
+        self.label = tk.Label(self.bar, textvariable=self.page, bg=bg)
+        self.goto = tk.Entry(self.bar, width=10, justify='c')
+        self.goto.bind('<Return>', lambda event: self.find(self.goto.get()))
+        self.previous.pack(side=tk.LEFT)
+        self.label.pack(side=tk.LEFT, padx=10)
+        self.next.pack(side=tk.LEFT)
+        tk.Label(self.bar, text='Go to feature:', bg=bg).pack(side=tk.LEFT, padx=(20, 2))
+        self.goto.pack(side=tk.LEFT)
+
+        self.bar.pack(side=tk.BOTTOM, fill=tk.X, pady=2)
+        self.scrollx.pack(side=tk.BOTTOM, fill=tk.X)
+        self.scrolly.pack(side=tk.RIGHT, fill=tk.Y)
+        self.table.pack(side=tk.LEFT, fill=tk.BOTH, expand=True)
+        self.show(0)
+
+    def show(self, start):
+        "Fill the table with the page of rows beginning at start"
+        self.start = int(min(max(start, 0), max(self.n - 1, 0) // self.rows * self.rows))
+        end = min(self.start + self.rows, self.n)
+        self.table.delete(*self.table.get_children())
+        for i in range(self.start, end):
+            cols, values = weights.neighbors(self.Cs, i)
+            normalized = np.asarray(self.Ws[i, cols].todense()).ravel() if len(cols) else []
+            row = [self.ids[i], len(cols), ' '.join(map(str, self.ids[cols])),
+                   ' '.join(f'{v:.4g}' for v in values), ' '.join(f'{v:.4g}' for v in normalized)]
+            if self.dev is not None:
+                row.append(f'{self.dev[i]:.4g}')
+            self.table.insert('', tk.END, values=row)
+        self.page.set(f'{self.start + 1}-{end} of {self.n}')
+
+    def find(self, feature):
+        "Jump to the page of a feature id"
+        matches = np.nonzero(self.ids.astype(str) == feature.strip())[0]
+        if len(matches):
+            self.show(matches[0] // self.rows * self.rows)
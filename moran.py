@@ -0,0 +1,268 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+#+----------+-----------------------------------------------------------------+
+#|   TITLE  | Moran's I Statistics                                            |
+#+----------+-----------------------------------------------------------------+
+#|  DETAILS |Numerical kernels of the Moran's I calculator. Every statistic is |
+#|          |evaluated over the sparse weight links, no n x n temporaries.    |
+#+----------+-----------------------------------------------------------------+
+
+import numpy as np
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+
+
+#-----------------------------------------------------------------------------#
+#------------------------------ M O R A N S   I ------------------------------#
+#-----------------------------------------------------------------------------#
+#Residual vectors are n long for one attribute or n x m for m attributes,
+#every statistic is then returned per attribute
+
+def deviations(ft):
+    "Residuals of the attribute(s) from their mean"
+    ft = np.asarray(ft, dtype=float)
+    return ft - np.mean(ft, axis=0)
+
+def crossProduct(dev, Ws):
+    "Weighted sum of residual cross products, dev' W dev, in O(nnz)"
+    return np.einsum('i...,i...->...', dev, Ws @ dev)
+
+def scale(Ws):
+    "n / S0, the factor of Moran's I, above 1 when features without neighbors leave rows empty"
+    return Ws.shape[0] / Ws.sum()
+
+def moransI(dev, Ws):
+    "Moran's I of the residuals dev over the weight table Ws"
+    return scale(Ws) * crossProduct(dev, Ws) / np.einsum('i...,i...->...', dev, dev)
+
+#-----------------------------------------------------------------------------#
+#--------------------- A N A L Y T I C A L   I N F E R E N C E ---------------#
+#-----------------------------------------------------------------------------#
+INFERENCE = ['Randomization', 'Normality', 'Permutations']
+
+def weightSums(Ws):
+    "Weight moments S0, S1 and S2 of a sparse weight table, in O(nnz)"
+    S0 = Ws.sum()
+    S1 = 0.5 * (Ws + Ws.T).power(2).sum()
+    S2 = np.sum((np.asarray(Ws.sum(axis=1)).ravel() + np.asarray(Ws.sum(axis=0)).ravel())**2)
+    return float(S0), float(S1), float(S2)
+
+def analytical(dev, Ws, I=None):
+    "Expectation, variance, z and two sided p of Moran's I under normality and randomization"
+    from scipy.special import ndtr
+    n = len(dev)
+    I = moransI(dev, Ws) if I is None else I
+    S0, S1, S2 = weightSums(Ws)
+    EI = -1 / (n - 1)
+    
+    VIn = (n**2 * S1 - n * S2 + 3 * S0**2) / ((n**2 - 1) * S0**2) - EI**2
+    #Kurtosis of the attribute(s) enters the randomization variance
+    ss = np.einsum('i...,i...->...', dev, dev)
+    b2 = n * np.sum(dev**4, axis=0) / ss**2
+    VIr = (n * ((n**2 - 3*n + 3) * S1 - n * S2 + 3 * S0**2) - b2 * ((n**2 - n) * S1 - 2 * n * S2 + 6 * S0**2)) / ((n - 1) * (n - 2) * (n - 3) * S0**2) - EI**2
+    
+    zn, zr = (I - EI) / np.sqrt(VIn), (I - EI) / np.sqrt(VIr)
+    return {'EI': EI, 'VI_norm': VIn, 'z_norm': zn, 'p_norm': 2 * ndtr(-np.abs(zn)),
+            'VI_rand': VIr, 'z_rand': zr, 'p_rand': 2 * ndtr(-np.abs(zr))}
+
+#-----------------------------------------------------------------------------#
+#------------------------- P E R M U T A T I O N S ---------------------------#
+#-----------------------------------------------------------------------------#
+BLOCK_BYTES = 64 * 2**20
+BLOCK_MAX = 256
+
+def runBlocks(tasks, total, workers=1, progress=None):
+    "Run every task, threaded when workers > 1, reporting the items finished"
+    #Each task returns how many items it finished, progress(done, total) may
+    #raise to stop the run (e.g. when the user cancels it)
+    lock = threading.Lock()
+    done = [0]
+    
+    def call(task):
+        count = task()
+        if progress is not None:
+            with lock:
+                done[0] += count
+                progress(done[0], total)
+    
+    #Threads share the data without copies, the sparse products release the GIL
+    if workers and workers > 1:
+        with ThreadPoolExecutor(workers) as pool:
+            list(pool.map(call, tasks))
+    else:
+        for task in tasks:
+            call(task)
+
+def blockSize(n, nperm):
+    "Permutations per block, so a block of permuted residuals fits BLOCK_BYTES"
+    return int(max(1, min(nperm, BLOCK_MAX, BLOCK_BYTES // (16 * max(n, 1)))))
+
+def permutedI(dev, Ws, size, rng):
+    "Moran's I of a block of size random permutations in one sparse product"
+    n, shape = len(dev), dev.shape
+    dev = dev.reshape(n, -1)
+    m = dev.shape[1]
+    
+    #All attributes of a feature move together, each column is one permutation
+    perms = rng.permuted(np.broadcast_to(np.arange(n)[:, None], (n, size)), axis=0)
+    Z = dev[perms].reshape(n, size * m)
+    reps = scale(Ws) * np.einsum('ij,ij->j', Z, Ws @ Z).reshape(size, m) / np.einsum('ij,ij->j', dev, dev)
+    return reps.reshape((size,) + shape[1:])
+
+def permutations(dev, Ws, nperm=999, seed=None, workers=1, progress=None):
+    "Reference distribution of Moran's I under nperm random permutations"
+    #Every block draws from its own stream spawned from the seed, so the
+    #result does not depend on how many workers share the blocks
+    reps = np.empty((nperm,) + dev.shape[1:])
+    block = blockSize(dev.size, nperm)
+    starts = range(0, nperm, block)
+    streams = np.random.SeedSequence(seed).spawn(len(starts))
+    
+    def run(start, stream):
+        size = min(block, nperm - start)
+        reps[start:start + size] = permutedI(dev, Ws, size, np.random.default_rng(stream))
+        return size
+    
+    runBlocks([partial(run, start, stream) for start, stream in zip(starts, streams)], nperm, workers, progress)
+    return reps
+
+def lagPermutations(dev, tables, nperm=999, seed=None, workers=1, progress=None):
+    "Reference distributions of Moran's I over several weight tables, nperm x lags"
+    #Every lag is evaluated on the same permuted residuals, a block is drawn
+    #once and multiplied through each table
+    n = len(dev)
+    reps = np.empty((nperm, len(tables)))
+    block = blockSize(n, nperm)
+    starts = range(0, nperm, block)
+    streams = np.random.SeedSequence(seed).spawn(len(starts))
+    ss = dev @ dev
+    factors = [scale(Ws) for Ws in tables]
+    
+    def run(start, stream):
+        size = min(block, nperm - start)
+        perms = np.random.default_rng(stream).permuted(np.broadcast_to(np.arange(n)[:, None], (n, size)), axis=0)
+        Z = dev[perms]
+        for lag, (Ws, factor) in enumerate(zip(tables, factors)):
+            reps[start:start + size, lag] = factor * np.einsum('ij,ij->j', Z, Ws @ Z) / ss
+        return size
+    
+    runBlocks([partial(run, start, stream) for start, stream in zip(starts, streams)], nperm, workers, progress)
+    return reps
+
+def pseudoPvalue(I, reps):
+    "One sided pseudo p-value in the direction of the observed statistic"
+    larger = np.sum(reps >= I, axis=0)
+    larger = np.minimum(larger, len(reps) - larger)
+    return (larger + 1) / (len(reps) + 1)
+
+#-----------------------------------------------------------------------------#
+#---------------------- B I V A R I A T E   M O R A N S   I ------------------#
+#-----------------------------------------------------------------------------#
+def standardize(dev):
+    "Residual columns scaled to unit sum of squares"
+    return dev / np.sqrt(np.einsum('ij,ij->j', dev, dev))
+
+def bivariate(dev, Ws):
+    "Matrix of bivariate Moran's I, x against the spatial lag of y, of every pair of n x m residual columns"
+    #The diagonal is the Moran's I of every column
+    Z = standardize(dev)
+    return scale(Ws) * Z.T @ (Ws @ Z)
+
+def bivariatePermutations(dev, Ws, I, nperm=999, seed=None, workers=1, progress=None):
+    "Mean, std and pseudo p-value of every entry of the bivariate Moran's I matrix I under nperm permutations"
+    #The lagged attributes are permuted together, each block is one sparse
+    #product of the n x (block m) permuted table and one dense product. Only
+    #running moments and counts are kept, not the nperm x m x m draws
+    Z = standardize(dev)
+    n, m = Z.shape
+    block = blockSize(n * m, nperm)
+    starts = range(0, nperm, block)
+    streams = np.random.SeedSequence(seed).spawn(len(starts))
+    lock = threading.Lock()
+    moments = {'count': 0, 'mean': np.zeros((m, m)), 'M2': np.zeros((m, m)), 'larger': np.zeros((m, m), dtype=int)}
+    
+    def run(start, stream):
+        size = min(block, nperm - start)
+        perms = np.random.default_rng(stream).permuted(np.broadcast_to(np.arange(n)[:, None], (n, size)), axis=0)
+        lags = Ws @ Z[perms].reshape(n, size * m)
+        reps = scale(Ws) * (Z.T @ lags).reshape(m, size, m).transpose(1, 0, 2)
+        mean, M2, larger = reps.mean(axis=0), np.sum((reps - reps.mean(axis=0))**2, axis=0), np.sum(reps >= I, axis=0)
+        #Blocks are merged with the parallel variance update of Chan et al.
+        with lock:
+            count = moments['count'] + size
+            delta = mean - moments['mean']
+            moments['M2'] += M2 + delta**2 * moments['count'] * size / count
+            moments['mean'] += delta * size / count
+            moments['larger'] += larger
+            moments['count'] = count
+        return size
+    
+    runBlocks([partial(run, start, stream) for start, stream in zip(starts, streams)], nperm, workers, progress)
+    larger = np.minimum(moments['larger'], nperm - moments['larger'])
+    return moments['mean'], np.sqrt(moments['M2'] / nperm), (larger + 1) / (nperm + 1)
+
+#-----------------------------------------------------------------------------#
+#------------------------ L O C A L   M O R A N S   I ------------------------#
+#-----------------------------------------------------------------------------#
+QUADRANTS = np.array(['High-High', 'Low-High', 'Low-Low', 'High-Low'])
+
+def localMoran(dev, Ws):
+    "Local Moran's I, spatial lag and quadrant (0 HH, 1 LH, 2 LL, 3 HL) of every feature"
+    z = dev / np.std(dev)
+    lag = Ws @ z
+    quadrant = np.where(z > 0, np.where(lag > 0, 0, 3), np.where(lag > 0, 1, 2))
+    return z * lag, lag, quadrant
+
+def degreeGroups(Ws):
+    "Rows of every distinct number of neighbors, each with its weights as a rows x degree table"
+    counts = np.diff(Ws.indptr)
+    groups = []
+    for degree in np.unique(counts[counts > 0]):
+        rows = np.nonzero(counts == degree)[0]
+        groups.append((rows, Ws.data[Ws.indptr[rows][:, None] + np.arange(degree)]))
+    return groups, counts
+
+def localPermutations(dev, Ws, nperm=999, seed=None, workers=1, progress=None):
+    "Conditional permutation pseudo p-values of the local Moran's I"
+    #Every permutation draws one random set of kmax other features, shared by
+    #all features (as in the conditional randomization of PySAL), a feature of
+    #degree d uses the first d of them. The draw skips the feature itself by
+    #shifting ids at or above it by one
+    n = len(dev)
+    z = dev / np.std(dev)
+    Ii = z * (Ws @ z)
+    groups, counts = degreeGroups(Ws)
+    kmax = int(counts.max()) if len(counts) else 0
+    rows = sum(len(group) for group, table in groups)
+    
+    #Rows of one degree are evaluated together, so the work is nnz x nperm
+    #whatever the largest degree, the draws are made per block of permutations
+    rng = np.random.default_rng(seed)
+    larger = np.zeros(n, dtype=int)
+    pblock = int(max(1, min(nperm, BLOCK_BYTES // (8 * max(kmax, 1)))))
+    
+    def run(ids, group, table):
+        degree = table.shape[1]
+        draws = ids[None, :, :degree] + (ids[None, :, :degree] >= group[:, None, None])
+        lags = np.einsum('ipk,ik->ip', z[draws], table)
+        larger[group] += np.sum(z[group, None] * lags >= Ii[group, None], axis=1)
+        return len(group)
+    
+    for pstart in range(0, nperm if groups else 0, pblock):
+        size = min(pblock, nperm - pstart)
+        ids = np.array([rng.choice(n - 1, kmax, replace=False) for p in range(size)]).reshape(size, kmax)
+        tasks = []
+        for group, table in groups:
+            block = int(max(1, BLOCK_BYTES // (8 * size * table.shape[1])))
+            tasks += [partial(run, ids, group[start:start + block], table[start:start + block]) for start in range(0, len(group), block)]
+        report = None if progress is None else partial(lambda pstart, done, total: progress(pstart * rows + done * size, nperm * rows), pstart)
+        runBlocks(tasks, rows, workers, report)
+    
+    larger = np.minimum(larger, nperm - larger)
+    pvalues = (larger + 1) / (nperm + 1)
+    #Features without neighbors have no local statistic to test
+    pvalues[counts == 0] = 1.0
+    return pvalues
@@ -0,0 +1,377 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+#+----------+-----------------------------------------------------------------+
+#|   TITLE  | Spatial Weights                                                 |
+#+----------+-----------------------------------------------------------------+
+#|  DETAILS |Sparse (CSR) weight tables shared by every method of the Moran's |
+#|          |I calculator. Memory and time scale with the number of neighbor  |
+#|          |links instead of n x n.                                          |
+#+----------+-----------------------------------------------------------------+
+
+import logging
+import numpy as np
+import os
+import pandas as pd
+import shapely
+from scipy import sparse
+
+log = logging.getLogger('moransi')
+
+
+
+#-----------------------------------------------------------------------------#
+#--------------------------- B U I L D   W E I G H T S -----------------------#
+#-----------------------------------------------------------------------------#
+def fromPairs(rows, cols, values, n):
+    "Build an n x n CSR weight table from (origin, destination, weight) links"
+    C = sparse.csr_matrix((np.asarray(values, dtype=float), (rows, cols)), shape= (n, n))
+    C.sum_duplicates()
+    C.eliminate_zeros()
+    C.sort_indices()
+    return C
+
+def firstK(C, k):
+    "Keep only the first k links (in column order) of every row"
+    C = sparse.csr_matrix(C)
+    C.sort_indices()
+    counts = np.diff(C.indptr)
+    position = np.arange(C.nnz) - np.repeat(C.indptr[:-1], counts)
+    keep = position < k
+    rows = np.repeat(np.arange(C.shape[0]), counts)[keep]
+    return fromPairs(rows, C.indices[keep], C.data[keep], C.shape[0])
+
+#-----------------------------------------------------------------------------#
+#-------------------------- C O N T I G U I T Y ------------------------------#
+#-----------------------------------------------------------------------------#
+CHUNK = 10000
+
+def contiguity(geoms, method='Rook', buffer=0, progress=None):
+    "Binary contiguity table from bulk STRtree queries of the polygons"
+    geoms = np.asarray(geoms)
+    tree = shapely.STRtree(geoms)
+    
+    #The polygons are queried in chunks so progress(rows, n) can follow
+    links = []
+    for start in range(0, len(geoms), CHUNK):
+        rows, cols = contiguousPairs(tree, geoms, geoms[start:start + CHUNK], method, buffer)
+        links.append((rows + start, cols))
+        if progress is not None:
+            progress(min(start + CHUNK, len(geoms)), len(geoms))
+    
+    rows = np.concatenate([r for r, c in links]) if links else np.array([], dtype=int)
+    cols = np.concatenate([c for r, c in links]) if links else np.array([], dtype=int)
+    other = rows != cols
+    return fromPairs(rows[other], cols[other], np.ones(np.count_nonzero(other)), len(geoms))
+
+def contiguousPairs(tree, geoms, chunk, method='Rook', buffer=0):
+    "Contiguous (chunk row, tree index) pairs of a chunk of polygons"
+    #Buffering both polygons by b is the same as a 2b distance tolerance
+    tolerance = 2 * buffer
+    if tolerance > 0:
+        rows, cols = tree.query(chunk, predicate= 'dwithin', distance= tolerance)
+        if method != 'Rook':
+            #Queen keeps neighbors within tolerance whose interiors do not overlap
+            touch = ~shapely.relate_pattern(chunk[rows], geoms[cols], 'T********')
+            rows, cols = rows[touch], cols[touch]
+    elif method == 'Rook':
+        rows, cols = tree.query(chunk, predicate= 'intersects')
+    else:
+        rows, cols = tree.query(chunk, predicate= 'touches')
+    return rows, cols
+
+#-----------------------------------------------------------------------------#
+#------------------ V E R T E X   H A S H   C O N T I G U I T Y --------------#
+#-----------------------------------------------------------------------------#
+#Standard definitions here: Queen polygons share a boundary point, Rook
+#polygons a boundary segment. On a clean coverage they share a vertex or an
+#edge, which hashing the vertices finds without any pairwise predicate
+DIRTY = 0.25
+
+def incidence(groups, members, n):
+    "Binary group x member incidence table, duplicates merged"
+    C = sparse.csr_matrix((np.ones(len(groups)), (groups, members)), shape= (int(groups.max(initial=-1)) + 1, n))
+    C.sum_duplicates()
+    C.data[:] = 1
+    return C
+
+def sharedBoundaryPairs(tree, geoms, chunk, method='Queen'):
+    "Pairs of (chunk row, tree index) sharing a boundary point (Queen) or segment (Rook)"
+    rows, cols = tree.query(chunk, predicate= 'touches')
+    if method == 'Rook':
+        edge = shapely.relate_pattern(chunk[rows], geoms[cols], '****1****')
+        rows, cols = rows[edge], cols[edge]
+    return rows, cols
+
+def vertexContiguity(geoms, method='Rook', tolerance=0, progress=None):
+    "Binary contiguity from shared vertices (Queen) or edges (Rook), predicates where the layer is not clean"
+    #Every edge of a clean coverage belongs to exactly two polygons. Polygons
+    #with an edge of any other count (layer border, gaps, overlaps or
+    #T-junctions) are linked with predicates instead, all of them when too
+    #many are dirty. A tolerance snaps the vertices to a grid first, polygons
+    #(or parts) it collapses are dirty too and linked by their original shape
+    geoms = np.asarray(geoms)
+    n = len(geoms)
+    snapped = geoms
+    collapsed = np.zeros(n, dtype= bool)
+    if tolerance > 0:
+        snapped = shapely.set_precision(geoms, tolerance)
+        collapsed = (shapely.get_num_geometries(snapped) != shapely.get_num_geometries(geoms)) | (shapely.is_empty(snapped) & ~shapely.is_empty(geoms))
+    parts, owner = shapely.get_parts(snapped, return_index= True)
+    polygon = shapely.get_type_id(parts) == 3
+    parts, owner = parts[polygon], owner[polygon]
+    if not len(parts):
+        #Nothing survives the snapping, the original vertices are hashed
+        return vertexContiguity(geoms, method, 0, progress) if collapsed.any() else fromPairs([], [], [], n)
+    coords, (rings, offsets) = shapely.to_ragged_array(parts, include_z= False)[1:]
+    
+    #Vertex ids hash the exact (snapped) coordinates, every vertex keeps its polygon
+    vertex = pd.factorize(np.ascontiguousarray(coords).view(np.complex128).ravel())[0]
+    owners = np.repeat(owner, np.diff(offsets))
+    owners = np.repeat(owners, np.diff(rings))
+    
+    #Edges join consecutive vertices of a ring, the closing vertex starts none
+    start = np.ones(len(coords), dtype= bool)
+    start[rings[1:] - 1] = False
+    a, b = vertex[start], vertex[np.roll(start, 1)]
+    keep = a != b
+    a, b = a[keep], b[keep]
+    edge = pd.factorize(np.minimum(a, b) * (len(coords) + 1) + np.maximum(a, b))[0]
+    edges = incidence(edge, owners[start][keep], n)
+    if progress is not None:
+        progress(1, 3)
+    
+    #Products of the incidence tables link the polygons of every shared edge or vertex
+    counts = np.diff(edges.indptr)
+    dirty = collapsed.copy()
+    dirty[edges.indices[np.repeat(counts != 2, counts)]] = True
+    links = edges if method == 'Rook' else incidence(vertex, owners, n)
+    links = sparse.coo_matrix(links.T @ links)
+    rows, cols = links.row, links.col
+    clean = ~dirty[rows] & ~dirty[cols]
+    rows, cols = rows[clean], cols[clean]
+    if progress is not None:
+        progress(2, 3)
+    
+    if dirty.any():
+        log.info(f'vertex contiguity: {np.count_nonzero(dirty)} of {n} polygons not clean ({np.count_nonzero(collapsed)} collapsed by snapping), linked with predicates')
+    if np.count_nonzero(dirty) > DIRTY * n:
+        tree = shapely.STRtree(geoms)
+        rows, cols = sharedBoundaryPairs(tree, geoms, geoms, method)
+    elif dirty.any():
+        tree = shapely.STRtree(geoms)
+        ids = np.nonzero(dirty)[0]
+        drows, dcols = sharedBoundaryPairs(tree, geoms, geoms[ids], method)
+        rows, cols = np.concatenate([rows, ids[drows]]), np.concatenate([cols, dcols])
+    #Links found from both sides or by both passes are merged, not summed
+    other = rows != cols
+    C = fromPairs(np.concatenate([rows[other], cols[other]]), np.concatenate([cols[other], rows[other]]), np.ones(2 * np.count_nonzero(other)), n)
+    C.data[:] = 1
+    if progress is not None:
+        progress(3, 3)
+    return C
+
+#-----------------------------------------------------------------------------#
+#---------------------- N E A R E S T   N E I G H B O R S --------------------#
+#-----------------------------------------------------------------------------#
+def knn(coords, k, tree=None):
+    "Exactly k nearest neighbors of every point, ties broken by feature index"
+    coords = np.asarray(coords, dtype=float)
+    n = len(coords)
+    k = int(min(k, n - 1))
+    tree = pointTree(coords) if tree is None else tree
+    
+    #Two extra candidates cover the point itself and reveal ties past the k-th
+    dists, idx = tree.query(coords, min(k + 2, n))
+    dists = np.atleast_2d(dists).reshape(n, -1)
+    idx = np.atleast_2d(idx).reshape(n, -1)
+    other = idx != np.arange(n)[:, None]
+    other &= np.cumsum(other, axis=1) <= k + 1
+    dists = dists[other].reshape(n, -1)
+    idx = idx[other].reshape(n, -1)
+    
+    order = np.lexsort((idx, dists), axis=1)
+    dists = np.take_along_axis(dists, order, 1)
+    idx = np.take_along_axis(idx, order, 1)
+    
+    #Rows where the k-th distance is tied beyond the candidates are re-queried
+    #together, with twice the candidates until every tie of the k-th is in
+    tied = np.nonzero(dists[:, k] == dists[:, k - 1])[0] if idx.shape[1] > k else []
+    m = k + 2
+    while len(tied):
+        m = min(2 * m, n)
+        tdists, tidx = tree.query(coords[tied], m)
+        tdists, tidx = tdists.reshape(len(tied), m), tidx.reshape(len(tied), m)
+        other = tidx != tied[:, None]
+        other &= np.cumsum(other, axis=1) <= m - 1
+        tdists = tdists[other].reshape(len(tied), m - 1)
+        tidx = tidx[other].reshape(len(tied), m - 1)
+        
+        done = (tdists[:, -1] > dists[tied, k - 1]) | (m == n)
+        order = np.lexsort((tidx[done], tdists[done]), axis=1)[:, :k]
+        idx[tied[done], :k] = np.take_along_axis(tidx[done], order, 1)
+        dists[tied[done], :k] = np.take_along_axis(tdists[done], order, 1)
+        tied = tied[~done]
+    return idx[:, :k], dists[:, :k]
+
+def fromDistances(rows, cols, dists, n, power=0):
+    "Weight table of distance links, 1/d^power (power 0 gives binary weights)"
+    dists = np.asarray(dists, dtype=float)
+    if power == 0:
+        values = np.ones(len(dists))
+    else:
+        #Coincident centroids get no weight instead of an infinite one
+        values = np.divide(1, dists**power, out=np.zeros_like(dists), where= dists!=0)
+    return fromPairs(rows, cols, values, n)
+
+#-----------------------------------------------------------------------------#
+#------------------------- D I S T A N C E   B A N D -------------------------#
+#-----------------------------------------------------------------------------#
+def pointTree(coords):
+    "KD-tree over the centroid coordinates, shared by the distance queries"
+    from scipy.spatial import cKDTree
+    return cKDTree(np.asarray(coords, dtype=float))
+
+def distanceBounds(coords, tree=None):
+    "Smallest nearest neighbor distance and bounding box diagonal of the points"
+    coords = np.asarray(coords, dtype=float)
+    tree = pointTree(coords) if tree is None else tree
+    dists = tree.query(coords, 2)[0][:, 1]
+    dists = dists[dists > 0]
+    minDist = np.min(dists) if len(dists) else 0.0
+    maxDist = float(np.hypot(*np.ptp(coords, axis=0)))
+    return minDist, maxDist
+
+def distanceBand(coords, radius, k=None, tree=None):
+    "Links between points within radius, optionally only the k nearest of them"
+    coords = np.asarray(coords, dtype=float)
+    tree = pointTree(coords) if tree is None else tree
+    
+    if k is not None:
+        #The k nearest within radius are the k nearest neighbors cut at radius
+        idx, dists = knn(coords, k, tree)
+        rows = np.repeat(np.arange(len(coords)), idx.shape[1])
+        keep = dists.ravel() <= radius
+        return rows[keep], idx.ravel()[keep], dists.ravel()[keep]
+    
+    if not np.isfinite(radius):
+        raise ValueError("All neighbors within an infinite radius link every pair of points, give k or a finite radius")
+    pairs = tree.query_pairs(radius, output_type= 'ndarray')
+    rows = np.concatenate([pairs[:, 0], pairs[:, 1]])
+    cols = np.concatenate([pairs[:, 1], pairs[:, 0]])
+    return rows, cols, np.hypot(*(coords[rows] - coords[cols]).T)
+
+class Candidates(object):
+    "Sorted neighbor candidates of the points, kept between runs and cut per k and radius"
+    #The k nearest neighbors sorted by (distance, index) are a prefix of any
+    #larger k, and the links within a radius a subset of any larger radius,
+    #so only growing k or the radius needs a new query
+    def __init__(self, coords, tree=None):
+        self.coords = np.asarray(coords, dtype=float)
+        self.tree = pointTree(self.coords) if tree is None else tree
+        self.idx = np.empty((len(self.coords), 0), dtype=int)
+        self.dists = np.empty((len(self.coords), 0))
+        self.radius = -np.inf
+        self.pairs = None
+
+    def links(self, radius, k=None):
+        "Links between points within radius, optionally only the k nearest of them"
+        n = len(self.coords)
+        if k is not None:
+            k = int(min(k, n - 1))
+            if k > self.idx.shape[1]:
+                self.idx, self.dists = knn(self.coords, k, self.tree)
+            rows = np.repeat(np.arange(n), k)
+            cols, dists = self.idx[:, :k].ravel(), self.dists[:, :k].ravel()
+        else:
+            if radius > self.radius:
+                self.pairs = distanceBand(self.coords, radius, tree= self.tree)
+                self.radius = radius
+            rows, cols, dists = self.pairs
+        keep = dists <= radius
+        return rows[keep], cols[keep], dists[keep]
+
+#-----------------------------------------------------------------------------#
+#------------------------ N O R M A L I Z E   W E I G H T S ------------------#
+#-----------------------------------------------------------------------------#
+def rowStandardize(C):
+    "Divide every link by its row sum, rows without neighbors stay empty"
+    #Ws shares the index arrays of C (memory mapped ones too), only the
+    #weights are new
+    C = sparse.csr_matrix(C)
+    if not C.has_sorted_indices:
+        C = C.sorted_indices()
+    Rs = np.asarray(C.sum(axis=1), dtype=float).ravel()
+    inv = np.divide(1, Rs, out=np.zeros_like(Rs), where= Rs!=0)
+    Ws = sparse.csr_matrix((C.data * np.repeat(inv, np.diff(C.indptr)), C.indices, C.indptr), shape= C.shape)
+    Ws.has_sorted_indices = True
+    return Ws
+
+def neighbors(C, i):
+    "Neighbor indices and weights of feature i"
+    start, end = C.indptr[i], C.indptr[i + 1]
+    return C.indices[start:end], C.data[start:end]
+
+#-----------------------------------------------------------------------------#
+#------------------------- M A P P E D   W E I G H T S -----------------------#
+#-----------------------------------------------------------------------------#
+#A mapped table is a folder of raw .npy arrays (indptr, indices, data and the
+#row standardized wdata) that any number of processes open read only and
+#zero-copy, the pages are shared through the OS file cache
+
+def saveMapped(folder, C):
+    "Write a weight table and its row standardized weights as memory mappable arrays"
+    C = sparse.csr_matrix(C)
+    if not C.has_sorted_indices:
+        C = C.sorted_indices()
+    #Indices that fit in int32 are stored as such, so scipy keeps them as mapped
+    index = np.int32 if max(C.shape[0], C.nnz) < 2**31 else np.int64
+    os.makedirs(folder, exist_ok=True)
+    arrays = {'indptr': C.indptr.astype(index), 'indices': C.indices.astype(index),
+              'data': C.data.astype(float), 'wdata': rowStandardize(C).data.astype(float)}
+    for name, array in arrays.items():
+        np.save(os.path.join(folder, f'{name}.npy'), array)
+
+def loadMapped(folder):
+    "Weight table Cs and row standardized Ws of a mapped folder, read only and sharing memory"
+    arrays = {name: np.load(os.path.join(folder, f'{name}.npy'), mmap_mode='r') for name in ('indptr', 'indices', 'data', 'wdata')}
+    n = len(arrays['indptr']) - 1
+    Cs = sparse.csr_matrix((arrays['data'], arrays['indices'], arrays['indptr']), shape= (n, n))
+    Ws = sparse.csr_matrix((arrays['wdata'], arrays['indices'], arrays['indptr']), shape= (n, n))
+    Cs.has_sorted_indices = Ws.has_sorted_indices = True
+    return Cs, Ws
+
+#-----------------------------------------------------------------------------#
+#-------------------------- E X P O R T   W E I G H T S ----------------------#
+#-----------------------------------------------------------------------------#
+FORMATS = ['csv', 'gal', 'gwt', 'npz', 'parquet']
+
+def edgeList(C, ids=None):
+    "Weight table as (origin, destination, weight) links"
+    C = sparse.coo_matrix(C)
+    ids = np.arange(C.shape[0]) if ids is None else np.asarray(ids)
+    return pd.DataFrame({'origin': ids[C.row], 'destination': ids[C.col], 'weight': C.data})
+
+def writeWeights(C, filename, fmt='csv', ids=None, layer='layer', idvar='id'):
+    "Write a weight table as an edge list (csv, parquet), GAL, GWT or compressed npz"
+    if fmt == 'npz':
+        sparse.save_npz(filename, sparse.csr_matrix(C), compressed=True)
+    elif fmt == 'csv':
+        edgeList(C, ids).to_csv(filename, index=False)
+    elif fmt == 'parquet':
+        edgeList(C, ids).to_parquet(filename, index=False)
+    elif fmt == 'gwt':
+        with open(filename, 'w') as file:
+            file.write(f'0 {C.shape[0]} {layer} {idvar}\n')
+            edgeList(C, ids).to_csv(file, sep=' ', header=False, index=False)
+    elif fmt == 'gal':
+        C = sparse.csr_matrix(C)
+        ids = np.arange(C.shape[0]) if ids is None else np.asarray(ids)
+        counts = np.diff(C.indptr)
+        with open(filename, 'w') as file:
+            file.write(f'0 {C.shape[0]} {layer} {idvar}\n')
+            for i in range(C.shape[0]):
+                file.write(f'{ids[i]} {counts[i]}\n')
+                file.write(' '.join(map(str, ids[C.indices[C.indptr[i]:C.indptr[i + 1]]])) + '\n')
+    else:
+        raise ValueError(f"Unknown weights format: {fmt}")
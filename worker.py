@@ -0,0 +1,61 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import queue, threading
+
+class Cancelled(Exception):
+    pass
+
+class Worker(object):
+    "Runs a job on a background thread and posts its progress to the Tk main loop"
+    def __init__(self, master, job, done=None, progress=None, failed=None, cancelled=None, interval=100):
+        self.master = master
+        self.job = job
+        self.done = done
+        self.progress = progress
+        self.failed = failed
+        self.cancelled = cancelled
+        self.interval = interval
+        self.events = queue.Queue()
+        self.stop = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+        self.master.after(self.interval, self.poll)
+
+    def report(self, done, total):
+        "Progress hook handed to the job, raises Cancelled once cancel was asked"
+        if self.stop.is_set():
+            raise Cancelled()
+        self.events.put(('progress', (done, total)))
+
+    def cancel(self):
+        self.stop.set()
+
+    def run(self):
+        #Runs on the worker thread, it must not touch any Tk widget
+        try:
+            result = self.job(self.report)
+        except Cancelled:
+            self.events.put(('cancelled', None))
+        except Exception as error:
+            self.events.put(('failed', error))
+        else:
+            self.events.put(('done', result))
+
+    def poll(self):
+        "Hand the posted events to the callbacks on the Tk main loop"
+        finished = False
+        while True:
+            try:
+                event, value = self.events.get_nowait()
+            except queue.Empty:
+                break
+            callback = getattr(self, event)
+            if event == 'progress':
+                if callback:
+                    callback(*value)
+                continue
+            finished = True
+            if callback:
+                callback(value) if event != 'cancelled' else callback()
+        if not finished:
+            self.master.after(self.interval, self.poll)